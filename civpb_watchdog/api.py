@@ -0,0 +1,69 @@
+import json
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from urllib.parse import parse_qs, urlparse
+
+logger = logging.getLogger(__name__)
+
+
+def parse_address(spec, default_port):
+    try:
+        addr, port = spec.rsplit(":", 1)
+        port = int(port)
+    except ValueError:
+        addr = spec
+        port = default_port
+    return addr, port
+
+
+class Status:
+    # Returned by a route for a response with another HTTP status than 200.
+    def __init__(self, code, body):
+        self.code = code
+        self.body = body
+
+
+class ApiServer:
+    # Read-only HTTP/JSON endpoint. Routes map a path to a callable that gets
+    # the parsed query parameters and returns a JSON serializable object.
+    def __init__(self, spec, default_port=9147):
+        self.routes = {}
+        self._addr, self._port = parse_address(spec, default_port)
+
+    def add_route(self, path, handler):
+        self.routes[path] = handler
+
+    def start(self):
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                handler = routes.get(url.path)
+                if handler is None:
+                    self.send_error(404)
+                    return
+                try:
+                    result = handler(parse_qs(url.query))
+                except ValueError as e:
+                    self.send_error(400, str(e))
+                    return
+                code = 200
+                if isinstance(result, Status):
+                    code, result = result.code, result.body
+                body = json.dumps(result).encode()
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug("%s - %s", self.address_string(), format % args)
+
+        logger.info(f"Starting API server on {self._addr}:{self._port}")
+        server = ThreadingHTTPServer((self._addr, self._port), Handler)
+        server.daemon_threads = True
+        # As a daemon thread, this will be cleaned up automatically when the main program ends.
+        Thread(target=server.serve_forever, name="api server", daemon=True).start()
@@ -0,0 +1,125 @@
+import math
+
+
+class Ewma:
+    # Exponentially weighted moving average and mean deviation, as used for
+    # the TCP retransmission timeout (RFC 6298).
+    def __init__(self, alpha=0.125, beta=0.25):
+        self.alpha = alpha
+        self.beta = beta
+        self.mean = None
+        self.deviation = 0.0
+
+    def update(self, x):
+        if self.mean is None:
+            self.mean = x
+            self.deviation = x / 2
+        else:
+            self.deviation += self.beta * (abs(x - self.mean) - self.deviation)
+            self.mean += self.alpha * (x - self.mean)
+
+
+class P2Quantile:
+    # Streaming estimation of a single quantile with the P² algorithm
+    # (Jain & Chlamtac, 1985) in constant memory.
+    def __init__(self, p):
+        self.p = p
+        self.count = 0
+        self._heights = []
+        self._positions = [1, 2, 3, 4, 5]
+        self._desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self._increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    @property
+    def value(self):
+        if self.count == 0:
+            return None
+        if self.count <= 5:
+            heights = sorted(self._heights)
+            return heights[min(len(heights) - 1, int(self.p * len(heights)))]
+        return self._heights[2]
+
+    def update(self, x):
+        self.count += 1
+        heights = self._heights
+        if self.count <= 5:
+            heights.append(x)
+            if self.count == 5:
+                heights.sort()
+            return
+
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+
+        positions = self._positions
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self._desired[i] += self._increments[i]
+
+        for i in range(1, 4):
+            d = self._desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (
+                d <= -1 and positions[i - 1] - positions[i] < -1
+            ):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = self._linear(i, d)
+                heights[i] = height
+                positions[i] += d
+
+    def _parabolic(self, i, d):
+        q, n = self._heights, self._positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def _linear(self, i, d):
+        q, n = self._heights, self._positions
+        return q[i] + d * (q[i + d] - q[i]) / (n[i + d] - n[i])
+
+
+class GameBaseline:
+    # Learns the normal traffic of a game to derive the thresholds for
+    # disconnecting clients and detecting frozen servers. The thresholds
+    # are only raised above the configured values, up to twice of them,
+    # so a game with large saves or long pauses is not disconnected or
+    # revived by mistake.
+    def __init__(self, warmup=100):
+        self.warmup = warmup
+        # Number of server packets until a client replied, only for runs
+        # with upload packets that the client completed
+        self.upload_runs = P2Quantile(0.99)
+        # Seconds between active server packets while clients are connected
+        self.reply_gaps = P2Quantile(0.999)
+
+    def upload_run(self, packets):
+        self.upload_runs.update(packets)
+
+    def reply_gap(self, seconds):
+        self.reply_gaps.update(seconds)
+
+    def packet_limit(self, default, factor=3):
+        # Nothing is learned before enough uploads were seen.
+        if self.upload_runs.count < self.warmup:
+            return default
+        return _clamp(math.ceil(self.upload_runs.value * factor), default, default * 2)
+
+    def freeze_timeout(self, default, factor=4):
+        if self.reply_gaps.count < self.warmup:
+            return default
+        return _clamp(self.reply_gaps.value * factor, default, default * 2)
+
+
+def _clamp(value, lower, upper):
+    return max(lower, min(upper, value))
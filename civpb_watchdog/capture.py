@@ -0,0 +1,98 @@
+import logging
+import selectors
+import time
+
+from .packet import (
+    LINKTYPE_ETHERNET,
+    LINKTYPE_LINUX_SLL,
+    LINKTYPE_LINUX_SLL2,
+    LINKTYPE_NULL,
+    LINKTYPE_RAW,
+)
+
+logger = logging.getLogger(__name__)
+
+# scapy layer class of the received frames -> linktype for parse_frame.
+# Other classes, e.g., Raw for an unknown link layer, are passed on as
+# LINKTYPE_RAW, parse_frame checks the IP version.
+LINKTYPES = {
+    "Ether": LINKTYPE_ETHERNET,
+    "CookedLinux": LINKTYPE_LINUX_SLL,
+    "CookedLinuxV2": LINKTYPE_LINUX_SLL2,
+    "Loopback": LINKTYPE_NULL,
+    # Layer 3 classes, if scapy.layers.inet or inet6 are loaded
+    "IP": LINKTYPE_RAW,
+    "IPv6": LINKTYPE_RAW,
+    "IPv46": LINKTYPE_RAW,
+}
+
+
+def socket_linktype(sock):
+    # Interfaces without a link layer, e.g., tun or WireGuard, deliver the
+    # IP packets directly (lvl 3). Their layer class depends on the loaded
+    # scapy layers, so it is not used.
+    if getattr(sock, "lvl", 2) == 3:
+        return LINKTYPE_RAW
+    return LINKTYPES.get(sock.LL.__name__, LINKTYPE_RAW)
+
+
+class Capture:
+    # One capture socket per interface, multiplexed with selectors. The
+    # frames are passed on undissected, so scapy is only used to open the
+    # sockets with the compiled BPF filter.
+    def __init__(self, interfaces, bpf_filter):
+        # Importing scapy takes seconds, so only do this when actually
+        # starting to capture. Only the sockets and the link layers are
+        # needed, not the whole scapy.all.
+        import scapy.arch  # noqa: F401 (sets conf.L2listen)
+        import scapy.layers.l2  # noqa: F401 (registers the link layer types)
+        from scapy.config import conf
+
+        self._selector = selectors.DefaultSelector()
+        self._sockets = []
+        # Read by the HealthMonitor on another thread
+        self.frames = dict.fromkeys(interfaces, 0)
+        self.rounds = 0
+        self.stopped = False
+        try:
+            for interface in interfaces:
+                sock = conf.L2listen(iface=interface, filter=bpf_filter)
+                self._sockets.append(sock)
+                linktype = socket_linktype(sock)
+                self._selector.register(
+                    sock, selectors.EVENT_READ, (interface, linktype)
+                )
+                logger.info(f"Capturing on interface {interface}, linktype {linktype}")
+        except BaseException:
+            self.close()
+            raise
+
+    def run(self, handle_frame, timeout=1):
+        # Calls handle_frame(linktype, timestamp, frame) for each frame until
+        # stop is called.
+        frames = self.frames
+        while not self.stopped:
+            self.rounds += 1
+            for key, _ in self._selector.select(timeout):
+                _, frame, ts = key.fileobj.recv_raw()
+                if frame is None:
+                    continue
+                interface, linktype = key.data
+                frames[interface] += 1
+                if ts is None:
+                    ts = time.time()
+                handle_frame(linktype, ts, frame)
+
+    def stop(self):
+        # Can be called from any thread, run returns within its timeout.
+        self.stopped = True
+
+    def close(self):
+        for sock in self._sockets:
+            try:
+                self._selector.unregister(sock)
+            except (KeyError, ValueError):
+                pass
+            sock.close()
+        self._sockets = []
+        self._selector.close()
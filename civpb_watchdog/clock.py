@@ -0,0 +1,84 @@
+import heapq
+import itertools
+import logging
+import time
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+# Source of the current time and of the periodic tasks, i.e., the liveness
+# checks and the connection cleanup. The virtual clock is used to analyze
+# capture files and to simulate scenarios faster than real time.
+
+
+class Clock:
+    def time(self):
+        return time.time()
+
+    def call_every(self, interval, callback, name):
+        # Calls callback(now) every interval seconds on a daemon thread.
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    callback(self.time())
+                except Exception:
+                    logger.exception(f"error in {name}")
+
+        # As a daemon thread, this will be cleaned up automatically when the main program ends.
+        logger.debug(f"starting {name} thread")
+        Thread(target=run, name=name, daemon=True).start()
+
+    def run(self, callback, name):
+        # Calls callback() once on a daemon thread, e.g., a slow revive
+        # action that must not block the periodic tasks.
+        def run():
+            try:
+                callback()
+            except Exception:
+                logger.exception(f"error in {name}")
+
+        Thread(target=run, name=name, daemon=True).start()
+
+
+class VirtualClock(Clock):
+    # Time only advances explicitly. The periodic tasks are run on the
+    # calling thread when their time has come, in order of their due time.
+    def __init__(self, now=0.0):
+        self.now = now
+        self._tasks = []
+        self._seq = itertools.count()
+
+    def time(self):
+        return self.now
+
+    def call_every(self, interval, callback, name):
+        heapq.heappush(
+            self._tasks, (self.now + interval, next(self._seq), interval, callback)
+        )
+
+    def run(self, callback, name):
+        # Deterministic, so the callback is run right away.
+        callback()
+
+    def reset(self, now):
+        # Jumps to now, e.g., the first packet of a capture file, and
+        # restarts all periodic tasks from there.
+        self.now = now
+        tasks = sorted(self._tasks, key=lambda task: task[1])
+        self._tasks = [
+            (now + interval, seq, interval, cb) for _, seq, interval, cb in tasks
+        ]
+        heapq.heapify(self._tasks)
+
+    def advance_to(self, now):
+        tasks = self._tasks
+        while tasks and tasks[0][0] <= now:
+            due, seq, interval, callback = heapq.heappop(tasks)
+            self.now = due
+            callback(due)
+            heapq.heappush(tasks, (due + interval, seq, interval, callback))
+        self.now = max(self.now, now)
+
+    def advance(self, seconds):
+        self.advance_to(self.now + seconds)
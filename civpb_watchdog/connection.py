@@ -1,34 +1,61 @@
 import logging
-import socket
-import time
 
-# Packets for sending fake client replies
-from .pyip import ip as pyip_ip
-from .pyip import udp as pyip_udp
+from .events import EventType, event_log
+from .protocol import KEEPALIVE, SEQUENCED, UNKNOWN, classify, disconnect_message
+from .raw_socket import send_udp
 
 logger = logging.getLogger(__name__)
 
 
+def server_packet(game, payload, now, header_size):
+    # The part of a server packet that only concerns the game. It is also
+    # done for flows that are not a Connection yet, see ConnectionRegistry.
+    message_class = classify(payload)
+    # Add the size of the UDP (8) and IP headers (20 or 40)
+    game.metrics.send(len(payload) + header_size, message_class)
+
+    # If the game hangs with a "save error" popup only KEEPALIVE
+    # messages will be send, see protocol.py. All other messages are an
+    # indicator for the server sanity.
+    if message_class != KEEPALIVE:
+        game.network_reply(now)
+    return message_class
+
+
+def client_packet(game, payload, now):
+    # The part of a client packet that only concerns the game. It is also
+    # done for flows that are not a Connection yet, see ConnectionRegistry.
+    message_class = classify(payload)
+    game.metrics.recv(len(payload), message_class)
+    # The server liveness is not checked here, but aggregated per game
+    # and evaluated periodically by the LivenessScheduler. Payloads without
+    # the Pitboss header, e.g., of port scans, do not expect a reply.
+    if message_class != UNKNOWN:
+        game.liveness.client_packet(now)
+    return message_class
+
+
 class Connection:
-    def __init__(
-        self, client_ip, client_port, server_ip, server_port, packet_limit, now, game
-    ):
+    def __init__(self, client_ip, client_port, server_ip, server_port, now, game):
         self.client_ip = client_ip
         self.client_port = client_port
         self.server_ip = server_ip
         self.server_port = server_port
 
         self.game = game
-
-        self.packet_limit = packet_limit
-        self.activity_timeout = 5 * 60
+        self._header_size = 48 if ":" in server_ip else 28
 
         self.number_unanswered_outgoing_packets = 0
         self.number_unanswered_incoming_packets = 0
+        # Upload packets since the last client packet
+        self.number_unanswered_upload_packets = 0
         # Just unix timestamps
         self.time_last_outgoing_packet = now
         self.time_last_incoming_packet = now
         self.time_disconnected = None
+        self.time_created = now
+        # Second chance bit for the eviction, see ConnectionRegistry
+        self.referenced = True
 
         # This timestamp will be updated for a subset of all
         # outgoing packages.
@@ -38,7 +65,7 @@ class Connection:
         # count payload sizes of 5 or 10
         self.time_last_outgoing_active_packet = self.time_last_outgoing_packet
 
-        logger.debug("Detecting new connection {}".format(self))
+        logger.debug("Detecting new connection %s", self)
 
     def __str__(self):
         return "connection[{}:{}->{}]".format(
@@ -56,134 +83,121 @@ class Connection:
             s += " inactive"
         return s
 
+    def snapshot(self):
+        # Reads without the registry lock, so the values may be from
+        # different packets, but each single value is consistent.
+        return {
+            "client_ip": self.client_ip,
+            "client_port": self.client_port,
+            "server_ip": self.server_ip,
+            "server_port": self.server_port,
+            "unanswered_outgoing_packets": self.number_unanswered_outgoing_packets,
+            "time_created": float(self.time_created),
+            "time_last_incoming_packet": float(self.time_last_incoming_packet),
+            "time_last_outgoing_packet": float(self.time_last_outgoing_packet),
+            "time_last_outgoing_active_packet": float(
+                self.time_last_outgoing_active_packet
+            ),
+            "time_disconnected": (
+                None
+                if self.time_disconnected is None
+                else float(self.time_disconnected)
+            ),
+            "active": self.is_active(),
+        }
+
     def handle_server_to_client(self, payload, now):
         self.number_unanswered_outgoing_packets += 1
         self.time_last_outgoing_packet = now
 
-        # Add 28 bytes for UDP (8) and IP headers (20)
-        self.game.metrics.send(len(payload) + 28)
+        message_class = server_packet(self.game, payload, now, self._header_size)
 
         # logger.info("Package from Server, len={}".format( len(payload)))
         # logger.info("Content: {}".format(payload.hex()))
 
         # == Watchdog functionality ==
-        # If the game hangs with a "save error" popup only packages with
-        # payload length 3 or 8 will be send. For examples:
-        #     (fefe) 640009
-        #     (fefe) 0000590009dcdc01
-        #     (fefe) 64000a
-        #     (fefe) 00005a000adcdc01
-        # udp prefix
-        #
-        # If the game runs normal most idle packages has a
-        # payload length of 23, i. e
-        # (fefe) 00023b000bfdffffff01ffffffff143f02003d02000001
-        #
-        # Thus, if we ignore packages with length 3 and 8 we"ve
-        # got an indicator for the server sanity.
-
-        if len(payload) not in [5, 10]:
+        if message_class != KEEPALIVE:
             self.time_last_outgoing_active_packet = self.time_last_outgoing_packet
-            self.game.network_reply()
 
-        # TODO Check if we can also use different payload sizes here, but we
-        # need to make sure the specific information about the
-        # two 16bit numbers "A, B" is available.
-        if len(payload) not in [25, 37]:
+        if message_class != SEQUENCED:
             return
+        if not self.number_unanswered_upload_packets:
+            self.game.upload_started()
+        self.number_unanswered_upload_packets += 1
 
-        # This package could be indicate an upload error. Add the payload
-        # for this client (destination IP) to an set. Force analysis
+        # This package could be indicate an upload error. Force analysis
         # of the packages if an sufficient amount of packages reached.
         #
         # The length 35 occurs if the connections was aborted during the loading
         # of a game.
 
-        if self.number_unanswered_outgoing_packets < self.packet_limit:
+        # The limit may be learned from the traffic of the game.
+        if self.number_unanswered_outgoing_packets < self.game.packet_limit:
             return
 
         # TODO We could also check the time here,
         # but the packet count seems do be the better metric.
-        self.disconnect(payload)
+        self.disconnect(payload, now)
 
     def handle_client_to_server(self, payload, now):
-        self.game.metrics.recv(len(payload))
+        client_packet(self.game, payload, now)
 
         if self.number_unanswered_outgoing_packets > 100:
             logger.debug(
-                "Received client data at {} after {} server packets / {} seconds.".format(
-                    self,
-                    self.number_unanswered_outgoing_packets,
-                    now - self.time_last_incoming_packet,
-                )
+                "Received client data at %s after %s server packets / %s seconds.",
+                self,
+                self.number_unanswered_outgoing_packets,
+                now - self.time_last_incoming_packet,
             )
 
         # logger.info("Package to Server, len={}".format(len(payload)))
 
-        # Check if server is available. First check guarantee that
-        # first package of new client do not produce false positives.
-        #
-        # Note: This simple approach does only work for periods > 20s!
-        # If a single client try to join a blockaded game, at most
-        # 20 seconds elapse between two packages.
-        if (
-            now - self.time_last_incoming_packet < 22
-            and now - self.time_last_outgoing_active_packet > 18
-        ):
-            logger.debug(f"{self!r} - detected no network reply.")
-            # TODO (Ramk): Many false positives!
-            self.game.no_network_reply()
+        # Only completed uploads show how long the runs of a healthy
+        # client are, the packet limit is only checked for them.
+        if self.number_unanswered_upload_packets:
+            self.game.baseline.upload_run(self.number_unanswered_outgoing_packets)
+            self.end_upload()
 
         self.number_unanswered_outgoing_packets = 0
         self.time_last_incoming_packet = now
 
-    def disconnect(self, payload):
+    def disconnect(self, payload, now):
         # TODO Throttle disconnects!
         # Send fake packet to stop upload
-        # Structure of content:
-        #     254 254 06 B (A+1) (7 bytes)
-        #
-        # First 2 bytes marks it as udp paket(?!)
-        # Thrid bytes is command (close connection to client)
-        #   B and A+1 are to 16 bit numbers where A and B
-        #   are content of "payload"
-
-        aHi, aLow = payload[3], payload[4]
-        bHi, bLow = payload[5], payload[6]
-        a_plus_1 = (aHi * 256 + aLow + 1) % 65536
-
-        data = bytes([254, 254, 6, bHi, bLow, int(a_plus_1 / 256), (a_plus_1 % 256)])
-
-        logger.info("Disconnecting client at {!r}".format(self))
-        upacket = pyip_udp.Packet()
-        upacket.sport = self.client_port
-        upacket.dport = self.server_port
-        upacket.data = data
-
-        ipacket = pyip_ip.Packet()
-        ipacket.src = self.client_ip
-        ipacket.dst = self.server_ip
-        ipacket.df = 1
-        ipacket.ttl = 64
-        ipacket.p = 17
-
-        ipacket.data = pyip_udp.assemble(upacket, False)
-        raw_ip = pyip_ip.assemble(ipacket, 1)
+        data = disconnect_message(payload)
+
+        logger.info("Disconnecting client at %r", self)
+        event_log.emit(
+            EventType.FORCED_DISCONNECT,
+            self.game.game_id,
+            now,
+            client_ip=self.client_ip,
+            client_port=self.client_port,
+            unanswered_packets=self.number_unanswered_outgoing_packets,
+        )
+        self.time_disconnected = now
+        # The stalled run must not be learned as a normal one.
+        self.number_unanswered_outgoing_packets = 0
+        self.end_upload()
+        self.game.metrics.force_disconnect()
+        if self.game.dry_run:
+            return
 
         # Send fake packet to the PB server that looks like its coming from the client
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
-        except socket.error as e:
-            logger.error("Socket could not be created: {}".format(e))
+        send_udp(
+            self.client_ip, self.client_port, self.server_ip, self.server_port, data
+        )
 
-        sock.sendto(raw_ip, (ipacket.dst, 0))
-        self.time_disconnected = time.time()
-        self.number_unanswered_outgoing_packets = 0
-        self.game.metrics.force_disconnect()
+    def end_upload(self):
+        # Also called by the ConnectionRegistry when the connection is closed.
+        if self.number_unanswered_upload_packets:
+            self.number_unanswered_upload_packets = 0
+            self.game.upload_finished()
 
-    def is_active(self):
-        now = time.time()
+    def is_active(self, now=None):
+        if now is None:
+            now = self.game.clock.time()
         inactive_time = now - max(
             self.time_last_incoming_packet, self.time_last_outgoing_packet
         )
-        return inactive_time < self.activity_timeout
+        return inactive_time < self.game.activity_timeout
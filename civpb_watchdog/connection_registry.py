@@ -1,60 +1,216 @@
 import logging
-import time
-from threading import Lock, Thread
+from threading import Lock
 
-from .connection import Connection
+from .clock import Clock
+from .connection import Connection, client_packet, server_packet
+from .events import EventType, event_log
+from .heavy_hitters import SpaceSaving
+from .packet import format_address
+from .protocol import SEQUENCED, classify
 
 logger = logging.getLogger(__name__)
 
+# Directions of a flow on probation
+CLIENT_SEEN = 1
+SERVER_SEEN = 2
+BOTH_SEEN = CLIENT_SEEN | SERVER_SEEN
+
 
 class ConnectionRegistry:
-    def __init__(self, packet_limit, cleanup_interval=60):
-        self.packet_limit = packet_limit
+    # Memory stays bounded under port scans and spoofed floods: A new flow
+    # is put on probation in a fixed-size hash table and only becomes a
+    # Connection once packets in both directions were seen. A flow whose
+    # slot is taken by another flow is forgotten and starts over. The
+    # number of connections is capped, the CLOCK algorithm evicts one that
+    # has not seen packets since the hand last passed it.
+    def __init__(
+        self,
+        cleanup_interval=60,
+        heavy_clients_capacity=64,
+        capacity=1024,
+        probation_size=256,
+        clock=None,
+    ):
+        # Approximate traffic per client ip and game with bounded memory.
+        self._heavy_clients_capacity = heavy_clients_capacity
+        self._heavy_clients = {}
 
         self.lock = Lock()
+        # Copy-on-write: The dict is replaced on every insertion or removal of
+        # a connection, which is rare compared to packets. Readers can use the
+        # current dict without holding the lock, see snapshot.
         self._connections = {}
-        self._cleanup_interval = cleanup_interval
-        # As a daemon thread, this will be cleaned up automatically when the main program ends.
-        # Also the main thread will always get the KeyboardInterrupt, so we are fine.
-        self._cleanup_thread = Thread(
-            target=self._run_cleanup, name="connection cleanup", daemon=True
+        if capacity < 1 or probation_size < 1:
+            raise ValueError("capacity and probation_size must be positive")
+        self.capacity = capacity
+        # Connection ids in the order of the CLOCK
+        self._ring = []
+        self._hand = 0
+        # Slots of [connection_id, directions, first packet time] or None.
+        # The hash of bytes is randomized per process, so the slots cannot
+        # be targeted from outside.
+        self._probation = [None] * probation_size
+        self.cleanup_interval = cleanup_interval
+        # The main thread will always get the KeyboardInterrupt, so a
+        # background thread of the clock is fine.
+        clock = clock or Clock()
+        clock.call_every(cleanup_interval, self._cleanup, "connection cleanup")
+
+    def admit(self, connection_id, to_server, payload, now, game):
+        # Returns the new Connection or None if the flow stays on probation.
+        probation = self._probation
+        index = hash(connection_id) % len(probation)
+        slot = probation[index]
+        if slot is None or slot[0] != connection_id:
+            if slot is not None:
+                game.metrics.probation_displace()
+            game.metrics.probation_flow()
+            slot = [connection_id, 0, now]
+            probation[index] = slot
+        slot[1] |= CLIENT_SEEN if to_server else SERVER_SEEN
+        # Only clients that loaded the game get uploads, so the server
+        # vouches for them. This also covers uploads that were already
+        # stalled when the watchdog started.
+        if slot[1] != BOTH_SEEN and (to_server or classify(payload) != SEQUENCED):
+            return None
+        probation[index] = None
+        return self.add(connection_id, now, game, created=slot[2])
+
+    def add(self, connection_id, now, game, created=None):
+        # The addresses are packed, they are only formatted for new connections.
+        client_ip, client_port, server_ip, server_port = connection_id
+        con = Connection(
+            client_ip=format_address(client_ip),
+            client_port=client_port,
+            server_ip=format_address(server_ip),
+            server_port=server_port,
+            now=now if created is None else created,
+            game=game,
+        )
+        connections = dict(self._connections)
+        if len(connections) >= self.capacity:
+            self._close(connections, self._evict(connections), now)
+            self._ring[self._hand] = connection_id
+            self._hand = (self._hand + 1) % len(self._ring)
+        else:
+            self._ring.append(connection_id)
+        connections[connection_id] = con
+        self._connections = connections
+        game.metrics.connect()
+        event_log.emit(
+            EventType.CONNECTION_OPEN,
+            game.game_id,
+            now,
+            client_ip=con.client_ip,
+            client_port=client_port,
+        )
+        return con
+
+    def _evict(self, connections):
+        # Advances the hand to the first connection without packets since
+        # the last pass. Terminates within two rounds.
+        ring = self._ring
+        while True:
+            con = connections[ring[self._hand]]
+            if not con.referenced:
+                con.game.metrics.evict()
+                logger.info("Evicting %r, the registry is full.", con)
+                return ring[self._hand]
+            con.referenced = False
+            self._hand = (self._hand + 1) % len(ring)
+
+    def _close(self, connections, con_id, now):
+        con = connections.pop(con_id)
+        con.end_upload()
+        con.game.metrics.disconnect()
+        event_log.emit(
+            EventType.CONNECTION_CLOSE,
+            con.game.game_id,
+            now,
+            client_ip=con.client_ip,
+            client_port=con.client_port,
+            opened=float(con.time_created),
+            last_active=float(
+                max(con.time_last_incoming_packet, con.time_last_outgoing_packet)
+            ),
         )
-        logger.debug("starting cleanup thread")
-        self._cleanup_thread.start()
-
-    def get(self, client_ip, client_port, server_ip, server_port, now, game):
-        # This is more efficient than .get, because then we don"t have to create a useless Client object if
-        # Already exists
-        connection_id = (client_ip, client_port, server_ip, server_port)
-        if connection_id not in self._connections:
-            self._connections[connection_id] = Connection(
-                client_ip=client_ip,
-                client_port=client_port,
-                server_ip=server_ip,
-                server_port=server_port,
-                packet_limit=self.packet_limit,
-                now=now,
-                game=game,
-            )
-            game.metrics.connect()
-        return self._connections[connection_id]
-
-    def _cleanup(self):
+
+    def handle_packet(
+        self,
+        game,
+        to_server,
+        client_ip,
+        client_port,
+        server_ip,
+        server_port,
+        payload,
+        now,
+    ):
+        with self.lock:
+            heavy_clients = self._heavy_clients.get(game.game_id)
+            if heavy_clients is None:
+                heavy_clients = SpaceSaving(self._heavy_clients_capacity)
+                self._heavy_clients[game.game_id] = heavy_clients
+            heavy_clients.add(client_ip, len(payload))
+
+            connection_id = (client_ip, client_port, server_ip, server_port)
+            con = self._connections.get(connection_id)
+            if con is None:
+                con = self.admit(connection_id, to_server, payload, now, game)
+            if con is None:
+                # Only the game sees the packets of flows on probation.
+                # The Pitboss messages of clients still count for its
+                # liveness, a frozen server never answers new clients.
+                if to_server:
+                    client_packet(game, payload, now)
+                else:
+                    server_packet(
+                        game, payload, now, 48 if len(server_ip) == 16 else 28
+                    )
+                return
+            con.referenced = True
+            if to_server:
+                con.handle_client_to_server(payload, now)
+            else:
+                con.handle_server_to_client(payload, now)
+
+    def _cleanup(self, now):
         with self.lock:
-            logger.debug(
-                "Starting cleanup for {} connections.".format(len(self._connections))
-            )
+            # Flows that never completed an exchange. A stale slot would
+            # otherwise admit a flow with an old time_created.
+            probation = self._probation
+            for index, slot in enumerate(probation):
+                if slot is not None and now - slot[2] > self.cleanup_interval:
+                    probation[index] = None
+
+            logger.debug("Starting cleanup for %s connections.", len(self._connections))
             keys_to_del = []
-            for (con_id, con) in self._connections.items():
-                logger.debug("{!r}".format(con))
-                if not con.is_active():
+            for con_id, con in self._connections.items():
+                logger.debug("%r", con)
+                if not con.is_active(now):
                     keys_to_del.append(con_id)
 
+            if not keys_to_del:
+                return
+            connections = dict(self._connections)
             for con_id in keys_to_del:
-                self._connections[con_id].game.metrics.disconnect()
-                del self._connections[con_id]
+                self._close(connections, con_id, now)
 
-    def _run_cleanup(self):
-        while True:
-            time.sleep(self._cleanup_interval)
-            self._cleanup()
+            self._connections = connections
+            self._ring = [con_id for con_id in self._ring if con_id in connections]
+            self._hand = 0
+
+    def snapshot(self):
+        # Only a reference to the current dict is taken, the capture thread
+        # is never blocked by this.
+        return [con.snapshot() for con in self._connections.values()]
+
+    def top_clients(self, n):
+        # game_id -> [(client_ip, bytes, error)]
+        return {
+            game_id: [
+                (format_address(client_ip), count, error)
+                for client_ip, count, error in heavy_clients.top(n)
+            ]
+            for game_id, heavy_clients in list(self._heavy_clients.items())
+        }
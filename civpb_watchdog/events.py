@@ -0,0 +1,193 @@
+import itertools
+import json
+import logging
+import socket
+import time
+from collections import deque
+from enum import Enum, unique
+from queue import Empty, Full, Queue
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+
+@unique
+class EventType(Enum):
+    CONNECTION_OPEN = "connection_open"
+    CONNECTION_CLOSE = "connection_close"
+    FORCED_DISCONNECT = "forced_disconnect"
+    REVIVE = "revive"
+    SERVER_ONLINE = "server_online"
+
+
+class Event:
+    __slots__ = ("seq", "ts", "type", "game", "fields")
+
+    def __init__(self, seq, ts, type, game, fields):
+        self.seq = seq
+        self.ts = ts
+        self.type = type
+        self.game = game
+        self.fields = fields
+
+    # Formatting is only done by the consumers (sinks or API requests),
+    # never while emitting the event.
+    def to_dict(self):
+        d = {"seq": self.seq, "ts": float(self.ts), "type": self.type.value}
+        if self.game is not None:
+            d["game"] = self.game
+        d.update(self.fields)
+        return d
+
+    def __str__(self):
+        fields = " ".join(f"{k}={v}" for k, v in self.fields.items())
+        return f"{self.type.value}[{self.game}] {fields}"
+
+
+class EventLog:
+    # Keeps the latest events in a bounded ring buffer and forwards them to
+    # asynchronous sinks. As long as the log is disabled, emit does nothing.
+    def __init__(self, capacity=1024):
+        self.enabled = False
+        self._ring = deque(maxlen=capacity)
+        self._seq = itertools.count(1)
+        self._sinks = []
+        self._subscribers = []
+
+    def enable(self):
+        self.enabled = True
+
+    def add_sink(self, sink):
+        self._sinks.append(sink)
+        self.enable()
+
+    def remove_sink(self, sink):
+        self._sinks.remove(sink)
+
+    def subscribe(self, callback):
+        # callback(event) is called on the emitting thread and never misses
+        # an event, unlike a sink. Only for fast consumers, e.g., the summary
+        # of a capture file.
+        self._subscribers.append(callback)
+        self.enable()
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def emit(self, type, game=None, now=None, **fields):
+        if not self.enabled:
+            return
+        event = Event(
+            next(self._seq), time.time() if now is None else now, type, game, fields
+        )
+        self._ring.append(event)
+        for callback in self._subscribers:
+            callback(event)
+        for sink in self._sinks:
+            sink.put(event)
+
+    def since(self, seq=0):
+        # Copying a deque is atomic, so this never blocks the emitters.
+        return [event for event in list(self._ring) if event.seq > seq]
+
+    def query(self, params):
+        # Used for the HTTP pull endpoint of the ApiServer.
+        since = int(params.get("since", ["0"])[0])
+        return [event.to_dict() for event in self.since(since)]
+
+    def flush(self):
+        for sink in self._sinks:
+            sink.flush()
+
+
+class Sink:
+    # Base class for event sinks. Events are written on a separate thread,
+    # if the sink can't keep up, events are dropped instead of blocking.
+    def __init__(self, name, queue_size=10000):
+        self.dropped = 0
+        self._queue = Queue(maxsize=queue_size)
+        # As a daemon thread, this will be cleaned up automatically when the main program ends.
+        self._thread = Thread(target=self._run, name=f"event sink {name}", daemon=True)
+        self._thread.start()
+
+    def put(self, event):
+        try:
+            self._queue.put_nowait(event)
+        except Full:
+            self.dropped += 1
+
+    def flush(self):
+        self._queue.join()
+
+    def close(self):
+        # Stops the thread after all queued events are written.
+        self._queue.put(None)
+
+    def write(self, events):
+        raise NotImplementedError()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            # Drain everything that is available to write it as one batch.
+            while batch[-1] is not None:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Empty:
+                    break
+            closed = batch[-1] is None
+            events = batch[:-1] if closed else batch
+            try:
+                if events:
+                    self.write(events)
+            except Exception:
+                logger.exception(f"error while writing {len(events)} events")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+            if closed:
+                return
+
+
+class JsonLinesSink(Sink):
+    def __init__(self, path):
+        self._file = open(path, "a")
+        super().__init__("jsonl")
+
+    def write(self, events):
+        for event in events:
+            self._file.write(json.dumps(event.to_dict()))
+            self._file.write("\n")
+        self._file.flush()
+
+
+class JournaldSink(Sink):
+    # Uses the native journald protocol: one datagram per event with
+    # KEY=value lines.
+    def __init__(self, path="/run/systemd/journal/socket"):
+        self._path = path
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        super().__init__("journald")
+
+    def write(self, events):
+        for event in events:
+            self._socket.sendto(self._format(event), self._path)
+
+    @staticmethod
+    def _format(event):
+        lines = [
+            f"MESSAGE={event}",
+            "PRIORITY=6",
+            "SYSLOG_IDENTIFIER=civpb-watchdog",
+            f"CIVPB_EVENT={event.type.value}",
+            f"CIVPB_SEQ={event.seq}",
+        ]
+        if event.game is not None:
+            lines.append(f"CIVPB_GAME={event.game}")
+        for key, value in event.fields.items():
+            lines.append(f"CIVPB_{key.upper()}={value}")
+        return ("\n".join(line.replace("\n", " ") for line in lines) + "\n").encode()
+
+
+# Global event log, configured by the command line
+event_log = EventLog()
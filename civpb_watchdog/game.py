@@ -1,10 +1,14 @@
 import logging
 import os
-import subprocess
-import time
 from enum import Enum, unique
 
+from .baseline import GameBaseline
+from .clock import Clock
+from .events import EventType, event_log
+from .liveness import LivenessTracker
 from .metrics import GameMetrics
+from .process import ScriptBackend
+from .revive import DEFAULT_PIPELINE, RevivePipeline, ReviveStateMachine
 
 logger = logging.getLogger(__name__)
 
@@ -18,9 +22,68 @@ class GameReviveStrategies(Enum):
     STOP_PB_SERVER = 4
 
 
+# Revive actions of the game config
+REVIVE_ACTIONS = {
+    "popup_confirm": GameReviveStrategies.POPUP_CONFIRM,
+    "restart_current_save": GameReviveStrategies.RESTART_SAVE,
+    "restart_old_save": GameReviveStrategies.RESTART_OLD_SAVE,
+    "stop": GameReviveStrategies.STOP_PB_SERVER,
+}
+
+# Settings of a game, can be overridden per game in the game config
+DEFAULT_SETTINGS = {
+    # Number of stray packets after which the client is disconnected
+    "packet_limit": 2000,
+    # Seconds without active server packets until the game is considered frozen
+    "freeze_timeout": 18,
+    # Seconds since the last client packet in which server packets are expected
+    "client_window": 22,
+    # Seconds until an idle connection is removed
+    "activity_timeout": 5 * 60,
+    # Learn packet_limit and freeze_timeout from the traffic, unless they
+    # are set explicitly for the game.
+    "adaptive": False,
+    # Steps to revive a frozen server, see revive.py
+    "revive": DEFAULT_PIPELINE,
+    # Packets waiting for the worker of the game with --isolate-games
+    "queue_size": 10000,
+    # Seconds a packet may wait in the queue of the worker
+    "latency_budget": 1.0,
+}
+
+
+def game_settings(game_config, game_id, defaults):
+    # game_config is the parsed TOML file with optional [defaults] and
+    # [games.GAME_ID] tables. Returns the settings and the names of the
+    # settings that are set explicitly in the file.
+    explicit = dict(game_config.get("defaults", {}))
+    explicit.update(game_config.get("games", {}).get(game_id, {}))
+    unknown = set(explicit) - set(DEFAULT_SETTINGS)
+    if unknown:
+        raise ValueError(f"Unknown settings for game {game_id}: {sorted(unknown)}")
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update(defaults)
+    settings.update(explicit)
+    return settings, set(explicit)
+
+
 class Game:
-    def __init__(self, altroot_and_port_str, script_path):
+    def __init__(
+        self,
+        altroot_and_port_str,
+        script_path,
+        dry_run=False,
+        defaults=None,
+        game_config=None,
+        backend=None,
+        clock=None,
+    ):
         self.script_path = script_path
+        # Runs the revive actions, see process.py
+        self.backend = backend or ScriptBackend(script_path)
+        self.clock = clock or Clock()
+        # Only log the revive actions instead of running them.
+        self.dry_run = dry_run
         path_port = altroot_and_port_str.split(":")
 
         self.path = path_port[0]
@@ -28,10 +91,31 @@ class Game:
 
         self.metrics = GameMetrics(self.game_id)
 
-        # Waiting time until next strategy will be used.
-        self.strategy_timeout_s = 30
-        self.latest_strategy = GameReviveStrategies.NO_STRATEGY
-        self.latest_strategy_ts = time.time()
+        settings, self._overrides = game_settings(
+            game_config or {}, self.game_id, defaults or {}
+        )
+        self._settings = settings
+        self.adaptive = settings["adaptive"]
+        self.activity_timeout = settings["activity_timeout"]
+        self.queue_size = settings["queue_size"]
+        self.latency_budget = settings["latency_budget"]
+        self.packet_limit = settings["packet_limit"]
+        self.liveness = LivenessTracker(
+            self.clock.time(),
+            reply_timeout=settings["freeze_timeout"],
+            client_window=settings["client_window"],
+        )
+        self.baseline = GameBaseline()
+        self.metrics.thresholds(self.packet_limit, self.liveness.reply_timeout)
+
+        # Connections with upload packets that the client did not answer
+        # yet, for the no_uploads condition of revive steps
+        self.uploading_connections = 0
+        # Set while a revive action runs on its own thread
+        self._reviving = False
+        self.revive_state = ReviveStateMachine(
+            RevivePipeline(settings["revive"]), self.clock.time()
+        )
 
         try:
             self.port = int(path_port[1])
@@ -42,6 +126,33 @@ class Game:
         )
         assert self.port > 0, "game port must be positive"
 
+    def snapshot(self):
+        last_client_packet = self.liveness.time_last_client_packet
+        return {
+            "game": self.game_id,
+            "path": self.path,
+            "port": self.port,
+            "revive_strategy": self.latest_strategy.name,
+            "revive_strategy_ts": self.latest_strategy_ts,
+            "time_last_server_active_packet": float(
+                self.liveness.time_last_server_active_packet
+            ),
+            "time_last_client_packet": (
+                None if last_client_packet is None else float(last_client_packet)
+            ),
+        }
+
+    @property
+    def latest_strategy(self):
+        step = self.revive_state.step
+        if step is None:
+            return GameReviveStrategies.NO_STRATEGY
+        return REVIVE_ACTIONS[step.action]
+
+    @property
+    def latest_strategy_ts(self):
+        return self.revive_state.time_last_transition
+
     @staticmethod
     def get_port_from_ini(path):
         port = None
@@ -60,62 +171,127 @@ class Game:
             raise RuntimeError(f"No port found in ini file {ini_path}")
         return port
 
+    def update_thresholds(self):
+        # Called periodically, so the per packet checks only read attributes.
+        if self.adaptive:
+            if "packet_limit" not in self._overrides:
+                self.packet_limit = self.baseline.packet_limit(
+                    self._settings["packet_limit"]
+                )
+            if "freeze_timeout" not in self._overrides:
+                self.liveness.reply_timeout = self.baseline.freeze_timeout(
+                    self._settings["freeze_timeout"]
+                )
+        self.metrics.thresholds(self.packet_limit, self.liveness.reply_timeout)
+        self.metrics.baseline(
+            self.baseline.upload_runs.value, self.baseline.reply_gaps.value
+        )
+
     # Server is active. Reset civpb_watchdog
-    def network_reply(self):
-        if self.latest_strategy != GameReviveStrategies.NO_STRATEGY:
+    def network_reply(self, now):
+        liveness = self.liveness
+        if liveness.client_active(now):
+            gap = now - liveness.time_last_server_active_packet
+            # Longer gaps are freezes, they must not raise the timeout.
+            if gap <= liveness.reply_timeout:
+                self.baseline.reply_gap(gap)
+        liveness.server_active(now)
+        if self.revive_state.state == 0:
+            # Fast path for every active packet
+            return
+        step = self.revive_state.online(now)
+        if step is not None:
             logger.info(
                 "Server of game {} is online again. Reset strategies.".format(
                     str(self.game_id)
                 )
             )
-            self.latest_strategy = GameReviveStrategies.NO_STRATEGY
-            self.latest_strategy_ts = (
-                time.time()
-            )  # Reset on strategy changes only should be fine.
-
-    # Server not responding. Try several awakening strategies.
-    def no_network_reply(self):
-        now = time.time()
-        if (now - self.latest_strategy_ts) < self.strategy_timeout_s:
+            event_log.emit(
+                EventType.SERVER_ONLINE,
+                self.game_id,
+                now,
+                previous_strategy=REVIVE_ACTIONS[step.action].name,
+            )
+
+    def upload_started(self):
+        self.uploading_connections += 1
+
+    def upload_finished(self):
+        self.uploading_connections -= 1
+
+    def revive_condition(self, condition, now):
+        if condition == "no_uploads":
+            # An upload ends when the client answers, is disconnected or its
+            # connection is closed after the activity timeout.
+            return self.uploading_connections == 0
+        raise ValueError(f"Unknown revive condition {condition}")
+
+    # Server not responding. Run the next step of the revive pipeline.
+    def no_network_reply(self, now=None):
+        if now is None:
+            now = self.clock.time()
+        if self._reviving:
+            logger.debug(f"Revive action of game {self.game_id} is still running.")
             return
-        self.latest_strategy_ts = now
-
-        if self.latest_strategy == GameReviveStrategies.NO_STRATEGY:
-            self.latest_strategy = GameReviveStrategies.POPUP_CONFIRM
-            logger.info("Simulate mouse click in game {}.".format(str(self.game_id)))
-            self.popup_confirm()
-            self.metrics.revive("popup_confirm")
-        elif self.latest_strategy == GameReviveStrategies.POPUP_CONFIRM:
-            self.latest_strategy = GameReviveStrategies.RESTART_SAVE
-            logger.info("Restart game {} with current save.".format(str(self.game_id)))
-            self.restart_game(False)
-            self.metrics.revive("restart_current_save")
-        elif self.latest_strategy == GameReviveStrategies.RESTART_SAVE:
-            self.latest_strategy = GameReviveStrategies.RESTART_OLD_SAVE
-            logger.info("Restart game {} with previous save.".format(str(self.game_id)))
-            self.restart_game(True)
-            self.metrics.revive("restart_old_save")
-        elif self.latest_strategy == GameReviveStrategies.RESTART_OLD_SAVE:
-            self.latest_strategy = GameReviveStrategies.STOP_PB_SERVER
+        step = self.revive_state.next_step(now, self.revive_condition)
+        if step is None:
+            return
+        # Not on the thread of the liveness scheduler, so a hanging action
+        # only delays the revive of this game.
+        self._reviving = True
+        self.clock.run(
+            lambda: self._run_revive(step.action, now), f"revive {self.game_id}"
+        )
+
+    def _run_revive(self, action, now):
+        try:
+            self.revive(action, now)
+        finally:
+            self._reviving = False
+
+    def revive(self, action, now):
+        prefix = "Dry run: " if self.dry_run else ""
+        if action == "popup_confirm":
+            logger.info(f"{prefix}Simulate mouse click in game {self.game_id}.")
+            success = self.popup_confirm()
+        elif action == "restart_current_save":
+            logger.info(f"{prefix}Restart game {self.game_id} with current save.")
+            success = self.restart_game(False)
+        elif action == "restart_old_save":
+            logger.info(f"{prefix}Restart game {self.game_id} with previous save.")
+            success = self.restart_game(True)
+        elif action == "stop":
             logger.info(
-                "All restart strategies failed. Kill game {} and wait for manual recovery.".format(
-                    str(self.game_id)
-                )
+                f"{prefix}All restart strategies failed. Kill game {self.game_id} and wait for manual recovery."
             )
-            self.stop_game()
-            self.metrics.revive("stop")
+            success = self.stop_game()
+        else:
+            raise ValueError(f"Unknown revive action {action}")
+        if not success:
+            logger.warning(f"Revive action {action} failed for game {self.game_id}.")
+        # Dry runs are only reported by the event.
+        if not self.dry_run:
+            self.metrics.revive(action)
+        fields = {"dry_run": True} if self.dry_run else {"success": success}
+        event_log.emit(EventType.REVIVE, self.game_id, now, strategy=action, **fields)
+
+    def reset(self, now):
+        # Assume an active server at the given time, e.g., the first packet
+        # of a capture file.
+        self.liveness.reset(now)
+        self.revive_state.reset(now)
 
     def popup_confirm(self):
-        subprocess.call(
-            [os.path.join(self.script_path, "civpb-confirm-popup"), str(self.game_id)]
-        )
+        if self.dry_run:
+            return True
+        return self.backend.popup_confirm(self)
 
     def restart_game(self, previous_save=False):
-        args = ["-p"] if previous_save else []
-        args.append(str(self.game_id))
-        subprocess.call([os.path.join(self.script_path, "civpb-kill"), *args])
+        if self.dry_run:
+            return True
+        return self.backend.restart_game(self, previous_save)
 
     def stop_game(self):
-        subprocess.call(
-            [os.path.join(self.script_path, "civpb-kill"), "-s", str(self.game_id)]
-        )
+        if self.dry_run:
+            return True
+        return self.backend.stop_game(self)
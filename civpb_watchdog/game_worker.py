@@ -0,0 +1,90 @@
+import logging
+import time
+from queue import Full, Queue
+from threading import Thread
+
+logger = logging.getLogger(__name__)
+
+
+class GameWorker:
+    # Processes the packets of a single game on its own thread with its own
+    # ConnectionRegistry. The capture thread only enqueues, so a game with
+    # a burst of packets only delays its own packets. The revive actions do
+    # not run here, but on their own thread, see Game.no_network_reply.
+    def __init__(self, game, registry):
+        self.game = game
+        self.registry = registry
+        # Per game, see the game config
+        self.latency_budget = game.latency_budget
+
+        self._queue = Queue(maxsize=game.queue_size)
+        self.game.metrics.track_queue()
+
+        # As a daemon thread, this will be cleaned up automatically when the main program ends.
+        self._thread = Thread(
+            target=self._run, name=f"game worker {game.game_id}", daemon=True
+        )
+        logger.debug(f"starting worker thread for game {game.game_id}")
+        self._thread.start()
+
+    def handle_packet(
+        self,
+        game,
+        to_server,
+        client_ip,
+        client_port,
+        server_ip,
+        server_port,
+        payload,
+        now,
+    ):
+        try:
+            self._queue.put_nowait(
+                (
+                    time.monotonic(),
+                    to_server,
+                    client_ip,
+                    client_port,
+                    server_ip,
+                    server_port,
+                    payload,
+                    now,
+                )
+            )
+        except Full:
+            # Backpressure: Rather drop packets of this game than
+            # blocking the capture of all other games.
+            self.game.metrics.queue_drop()
+            return
+        self.game.metrics.enqueue()
+
+    def _run(self):
+        while True:
+            (
+                enqueued,
+                to_server,
+                client_ip,
+                client_port,
+                server_ip,
+                server_port,
+                payload,
+                now,
+            ) = self._queue.get()
+            self.game.metrics.dequeue()
+            latency = time.monotonic() - enqueued
+            self.game.metrics.queue_latency(latency, latency > self.latency_budget)
+            try:
+                self.registry.handle_packet(
+                    self.game,
+                    to_server,
+                    client_ip,
+                    client_port,
+                    server_ip,
+                    server_port,
+                    payload,
+                    now,
+                )
+            except Exception:
+                logger.exception(
+                    f"error while processing packet of game {self.game.game_id}"
+                )
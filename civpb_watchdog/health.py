@@ -0,0 +1,244 @@
+import logging
+import os
+import random
+import socket
+
+from .api import Status
+from .baseline import Ewma
+from .clock import Clock
+
+logger = logging.getLogger(__name__)
+
+# Self-monitoring of the capture. The packet counters of the interfaces and
+# games are sampled periodically, so the capture thread only increments
+# counters. A stalled capture is reopened, a hanging capture thread stops
+# the systemd watchdog notifications, so systemd restarts the service.
+
+
+class ArrivalTracker:
+    # Packet arrival of an interface or game. Learns the usual time between
+    # samples with packets to decide whether silence is unusual.
+    def __init__(self):
+        self.count = 0
+        self.last_arrival = None
+        self.gaps = Ewma()
+
+    def sample(self, count, now):
+        if count == self.count:
+            return
+        if self.last_arrival is not None:
+            self.gaps.update(now - self.last_arrival)
+        self.count = count
+        self.last_arrival = now
+
+    def stall_timeout(self, min_timeout, factor=4):
+        gaps = self.gaps
+        if gaps.mean is None:
+            return min_timeout
+        return max(min_timeout, factor * (gaps.mean + 4 * gaps.deviation))
+
+    def stalled(self, now, min_timeout):
+        # Nothing can be said before the first packet.
+        if self.last_arrival is None:
+            return False
+        return now - self.last_arrival > self.stall_timeout(min_timeout)
+
+    def status(self, now, min_timeout):
+        return {
+            "packets": self.count,
+            "seconds_since_last_packet": (
+                None if self.last_arrival is None else now - self.last_arrival
+            ),
+            "stall_timeout": self.stall_timeout(min_timeout),
+            "stalled": self.stalled(now, min_timeout),
+        }
+
+
+class Backoff:
+    # Exponential backoff with jitter, so several watchdogs do not reopen
+    # their captures in lockstep.
+    def __init__(self, initial=1.0, maximum=60.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.attempts = 0
+
+    def reset(self):
+        self.attempts = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial * 2**self.attempts)
+        self.attempts += 1
+        return random.uniform(delay / 2, delay)
+
+
+class SystemdNotifier:
+    # sd_notify(3) without libsystemd. Does nothing if not started by
+    # systemd with Type=notify.
+    def __init__(self):
+        address = os.environ.get("NOTIFY_SOCKET")
+        self._socket = None
+        if not address:
+            return
+        if address.startswith("@"):
+            # Abstract namespace
+            address = "\0" + address[1:]
+        self._address = address
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # A busy systemd must not block the health monitor.
+        self._socket.setblocking(False)
+
+    @property
+    def enabled(self):
+        return self._socket is not None
+
+    def notify(self, message):
+        if self._socket is None:
+            return
+        try:
+            self._socket.sendto(message.encode(), self._address)
+        except OSError as e:
+            logger.warning(f"Failed to notify systemd: {e}")
+
+
+class HealthMonitor:
+    def __init__(
+        self, interfaces, games, stall_timeout=10, hang_timeout=30, clock=None
+    ):
+        self.stall_timeout = stall_timeout
+        # The capture loop must complete a round within this time.
+        self.hang_timeout = hang_timeout
+        self.interfaces = {interface: ArrivalTracker() for interface in interfaces}
+        self.games = {game.game_id: (game, ArrivalTracker()) for game in games}
+        self.notifier = SystemdNotifier()
+
+        self._clock = clock or Clock()
+        self._capture = None
+        self._rounds = None
+        self._last_round = None
+        self._ready = False
+        self._alive = True
+        self.reopens = 0
+
+    def start(self, interval=1):
+        self._clock.call_every(interval, self.check, "health monitor")
+
+    def attach(self, capture):
+        # Called by the capture thread for every new capture.
+        now = self._clock.time()
+        self._capture = capture
+        self._rounds = None
+        self._last_round = now
+        for tracker in self.interfaces.values():
+            # The frame counters start at zero for each capture.
+            tracker.count = 0
+            # Grace period for the new capture
+            if tracker.last_arrival is not None:
+                tracker.last_arrival = now
+
+    def detach(self, delay):
+        # Called by the capture thread before waiting delay seconds to
+        # reopen the capture. The wait does not count as a hang.
+        self._capture = None
+        self._last_round = self._clock.time() + delay
+
+    def check(self, now):
+        capture = self._capture
+        for game, tracker in self.games.values():
+            tracker.sample(game.metrics.packets_in + game.metrics.packets_out, now)
+
+        if capture is not None:
+            if capture.rounds != self._rounds:
+                self._rounds = capture.rounds
+                self._last_round = now
+            for interface, tracker in self.interfaces.items():
+                tracker.sample(capture.frames[interface], now)
+            if not self._ready:
+                self._ready = True
+                self.notifier.notify("READY=1")
+
+        # Also while waiting to reopen the capture, so a reopen does not
+        # end in a restart by systemd.
+        alive = self.alive(now)
+        if alive:
+            self.notifier.notify("WATCHDOG=1")
+        elif self._alive:
+            logger.error(
+                "Capture thread hangs, stopping systemd watchdog notifications."
+            )
+        self._alive = alive
+
+        if capture is None:
+            return
+        stalled = self.stalled_interfaces(now)
+        if stalled and not capture.stopped:
+            logger.warning(
+                f"No packets captured on {', '.join(stalled)}, reopening the capture."
+            )
+            self.reopens += 1
+            capture.stop()
+
+    def alive(self, now):
+        # Before the first capture, there is nothing to wait for.
+        return self._last_round is None or now - self._last_round <= self.hang_timeout
+
+    def traffic_missing(self, now):
+        # Idle servers are common, the players may only connect once a day,
+        # and then the filtered capture is silent. Only a game whose clients
+        # sent packets until shortly before its packets stopped shows that
+        # packets are missing. The connections are no indicator, they are
+        # kept for minutes after the last packet. After the last client
+        # left, this holds for at most one reopen.
+        for game, tracker in self.games.values():
+            last_client_packet = game.liveness.time_last_client_packet
+            if last_client_packet is None or not tracker.stalled(
+                now, self.stall_timeout
+            ):
+                continue
+            if now - last_client_packet <= 2 * tracker.stall_timeout(
+                self.stall_timeout
+            ):
+                return True
+        return False
+
+    def stalled_interfaces(self, now):
+        if not self.traffic_missing(now):
+            return []
+        return [
+            interface
+            for interface, tracker in self.interfaces.items()
+            if tracker.stalled(now, self.stall_timeout)
+        ]
+
+    def status(self, now=None):
+        now = self._clock.time() if now is None else now
+        return {
+            "alive": self.alive(now),
+            "ready": self.ready(now),
+            "capturing": self._capture is not None,
+            "reopens": self.reopens,
+            "interfaces": {
+                interface: tracker.status(now, self.stall_timeout)
+                for interface, tracker in self.interfaces.items()
+            },
+            "games": {
+                game_id: tracker.status(now, self.stall_timeout)
+                for game_id, (_, tracker) in self.games.items()
+            },
+        }
+
+    def ready(self, now):
+        return (
+            self._capture is not None
+            and self.alive(now)
+            and not self.stalled_interfaces(now)
+        )
+
+    def healthz(self, params):
+        # Used for the /healthz route of the ApiServer.
+        status = self.status()
+        return status if status["alive"] else Status(503, status)
+
+    def readyz(self, params):
+        # Used for the /readyz route of the ApiServer.
+        status = self.status()
+        return status if status["ready"] else Status(503, status)
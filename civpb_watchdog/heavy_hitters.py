@@ -0,0 +1,44 @@
+import heapq
+
+
+class SpaceSaving:
+    # Space-Saving algorithm (Metwally et al.) for weighted streams: Keeps
+    # approximate counts of the heaviest keys with a fixed number of counters.
+    # A reported count overestimates the true count by at most its error.
+    #
+    # The heap of counters is only updated lazily when a counter has to be
+    # evicted, so updating a tracked key is a single dict operation.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # key -> [count, error]
+        self._counters = {}
+        # (count, key), entries may be outdated
+        self._heap = []
+
+    def add(self, key, weight=1):
+        counter = self._counters.get(key)
+        if counter is not None:
+            counter[0] += weight
+            return
+
+        if len(self._counters) < self.capacity:
+            self._counters[key] = [weight, 0]
+            heapq.heappush(self._heap, (weight, key))
+            return
+
+        # Replace the key with the smallest count.
+        while True:
+            count, min_key = heapq.heappop(self._heap)
+            current = self._counters[min_key][0]
+            if current == count:
+                break
+            heapq.heappush(self._heap, (current, min_key))
+        del self._counters[min_key]
+        self._counters[key] = [count + weight, count]
+        heapq.heappush(self._heap, (count + weight, key))
+
+    def top(self, n):
+        # Copying the items is atomic, so this can be called from other threads.
+        items = list(self._counters.items())
+        items.sort(key=lambda item: item[1][0], reverse=True)
+        return [(key, count, error) for key, (count, error) in items[:n]]
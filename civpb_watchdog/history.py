@@ -0,0 +1,233 @@
+import json
+import sqlite3
+
+import click
+
+from .events import EventType, Sink
+
+# Session history in SQLite. The watchdog only appends, queries are done
+# with the civpb-history command.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    game TEXT NOT NULL,
+    client_ip TEXT NOT NULL,
+    client_port INTEGER NOT NULL,
+    opened REAL NOT NULL,
+    closed REAL NOT NULL,
+    forced_disconnects INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_client ON sessions (client_ip, opened);
+CREATE INDEX IF NOT EXISTS sessions_game ON sessions (game, opened);
+CREATE TABLE IF NOT EXISTS events (
+    ts REAL NOT NULL,
+    type TEXT NOT NULL,
+    game TEXT,
+    client_ip TEXT,
+    client_port INTEGER,
+    detail TEXT
+);
+CREATE INDEX IF NOT EXISTS events_client ON events (client_ip, ts);
+CREATE INDEX IF NOT EXISTS events_game ON events (game, ts);
+CREATE INDEX IF NOT EXISTS events_type ON events (type, ts);
+"""
+
+# Field of the event that is stored as detail
+DETAILS = {
+    EventType.FORCED_DISCONNECT: "unanswered_packets",
+    EventType.REVIVE: "strategy",
+    EventType.SERVER_ONLINE: "previous_strategy",
+}
+
+
+def connect(path):
+    db = sqlite3.connect(path, check_same_thread=False)
+    # Appending from the watchdog must not block readers.
+    db.execute("PRAGMA journal_mode=WAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+class HistorySink(Sink):
+    # Records closed sessions and all events. Each batch of events is
+    # written in a single transaction.
+    def __init__(self, path):
+        self._db = connect(path)
+        # (game, client_ip, client_port) -> forced disconnects of open sessions
+        self._forced_disconnects = {}
+        super().__init__("history")
+
+    def write(self, events):
+        sessions = []
+        rows = []
+        for event in events:
+            fields = event.fields
+            key = (event.game, fields.get("client_ip"), fields.get("client_port"))
+            if event.type == EventType.CONNECTION_OPEN:
+                self._forced_disconnects[key] = 0
+            elif event.type == EventType.FORCED_DISCONNECT:
+                self._forced_disconnects[key] = self._forced_disconnects.get(key, 0) + 1
+            elif event.type == EventType.CONNECTION_CLOSE:
+                sessions.append(
+                    (
+                        *key,
+                        fields["opened"],
+                        # The cleanup runs only every minute.
+                        fields.get("last_active", float(event.ts)),
+                        self._forced_disconnects.pop(key, 0),
+                    )
+                )
+                # The session row contains everything of the close event.
+                continue
+            detail = fields.get(DETAILS.get(event.type))
+            rows.append(
+                (
+                    float(event.ts),
+                    event.type.value,
+                    *key,
+                    None if detail is None else str(detail),
+                )
+            )
+        with self._db:
+            self._db.executemany(
+                "INSERT INTO sessions VALUES (?, ?, ?, ?, ?, ?)", sessions
+            )
+            self._db.executemany("INSERT INTO events VALUES (?, ?, ?, ?, ?, ?)", rows)
+
+
+def _where(conditions):
+    # conditions: list of (sql, value), value None means no condition.
+    used = [(sql, value) for sql, value in conditions if value is not None]
+    if not used:
+        return "", []
+    return " WHERE " + " AND ".join(sql for sql, _ in used), [v for _, v in used]
+
+
+def query_clients(db, game=None, since=None, limit=50):
+    # Sessions and forced disconnects per client, most disconnected first.
+    where, params = _where([("game = ?", game), ("opened >= ?", since)])
+    rows = db.execute(
+        "SELECT client_ip, game, COUNT(*), SUM(closed - opened), "
+        "AVG(closed - opened), SUM(forced_disconnects) "
+        f"FROM sessions{where} GROUP BY client_ip, game "
+        "ORDER BY SUM(forced_disconnects) DESC, COUNT(*) DESC LIMIT ?",
+        params + [limit],
+    )
+    return [
+        {
+            "client_ip": client_ip,
+            "game": game_id,
+            "sessions": sessions,
+            "total_seconds": total,
+            "average_seconds": average,
+            "forced_disconnects": forced,
+        }
+        for client_ip, game_id, sessions, total, average, forced in rows
+    ]
+
+
+def query_sessions(db, client_ip=None, game=None, since=None, limit=50):
+    where, params = _where(
+        [("client_ip = ?", client_ip), ("game = ?", game), ("opened >= ?", since)]
+    )
+    rows = db.execute(
+        "SELECT game, client_ip, client_port, opened, closed, forced_disconnects "
+        f"FROM sessions{where} ORDER BY opened DESC LIMIT ?",
+        params + [limit],
+    )
+    return [
+        {
+            "game": game,
+            "client_ip": client_ip,
+            "client_port": client_port,
+            "opened": opened,
+            "closed": closed,
+            "duration": closed - opened,
+            "forced_disconnects": forced,
+        }
+        for game, client_ip, client_port, opened, closed, forced in rows
+    ]
+
+
+def query_events(db, type=None, client_ip=None, game=None, since=None, limit=50):
+    where, params = _where(
+        [
+            ("type = ?", type),
+            ("client_ip = ?", client_ip),
+            ("game = ?", game),
+            ("ts >= ?", since),
+        ]
+    )
+    rows = db.execute(
+        "SELECT ts, type, game, client_ip, client_port, detail "
+        f"FROM events{where} ORDER BY ts DESC LIMIT ?",
+        params + [limit],
+    )
+    return [
+        {
+            "ts": ts,
+            "type": type,
+            "game": game,
+            "client_ip": client_ip,
+            "client_port": client_port,
+            "detail": detail,
+        }
+        for ts, type, game, client_ip, client_port, detail in rows
+    ]
+
+
+def _since(value):
+    return None if value is None else value.timestamp()
+
+
+@click.group()
+@click.option(
+    "--db",
+    required=True,
+    type=click.Path(exists=True, dir_okay=False),
+    help="session history of the watchdog, see civpb-watchdog --history",
+)
+@click.pass_context
+def main(ctx, db):
+    """Queries the session history of the Pitboss watchdog."""
+    ctx.obj = sqlite3.connect(f"file:{db}?mode=ro", uri=True)
+
+
+@main.command()
+@click.option("--game", default=None)
+@click.option("--since", type=click.DateTime(), default=None)
+@click.option("--limit", type=int, default=50)
+@click.pass_obj
+def clients(db, game, since, limit):
+    """Sessions and forced disconnects per client."""
+    click.echo(json.dumps(query_clients(db, game, _since(since), limit), indent=2))
+
+
+@main.command()
+@click.option("--client", "client_ip", default=None, metavar="IP")
+@click.option("--game", default=None)
+@click.option("--since", type=click.DateTime(), default=None)
+@click.option("--limit", type=int, default=50)
+@click.pass_obj
+def sessions(db, client_ip, game, since, limit):
+    """Latest closed sessions."""
+    result = query_sessions(db, client_ip, game, _since(since), limit)
+    click.echo(json.dumps(result, indent=2))
+
+
+@main.command()
+@click.option(
+    "--type",
+    "event_type",
+    type=click.Choice([t.value for t in EventType if t != EventType.CONNECTION_CLOSE]),
+    default=None,
+)
+@click.option("--client", "client_ip", default=None, metavar="IP")
+@click.option("--game", default=None)
+@click.option("--since", type=click.DateTime(), default=None)
+@click.option("--limit", type=int, default=50)
+@click.pass_obj
+def events(db, event_type, client_ip, game, since, limit):
+    """Latest events, e.g., forced disconnects and revive actions."""
+    result = query_events(db, event_type, client_ip, game, _since(since), limit)
+    click.echo(json.dumps(result, indent=2))
@@ -0,0 +1,81 @@
+import logging
+
+from .clock import Clock
+
+logger = logging.getLogger(__name__)
+
+
+class LivenessTracker:
+    # Aggregates the liveness of the server of one game over all of its
+    # connections. Updating is O(1) per packet, evaluation is O(1) per game.
+    def __init__(self, now, reply_timeout=18, client_window=22, client_messages=3):
+        # A server must have sent an active packet within reply_timeout
+        # seconds as long as a client has sent something within the
+        # last client_window seconds.
+        #
+        # Note: This simple approach does only work for periods > 20s!
+        # If a single client try to join a blockaded game, at most
+        # 20 seconds elapse between two packages.
+        self.reply_timeout = reply_timeout
+        self.client_window = client_window
+        # Pitboss messages of clients without an active server packet in
+        # between, each within client_window of the previous one. Any
+        # client counts, also one the server never answered, e.g., after
+        # reconnecting to a frozen server. Several are required, so a
+        # single stray packet does not start the revive escalation.
+        self.client_messages = client_messages
+        self.unanswered_client_messages = 0
+
+        # We assume an active server due the creation of this object
+        # to avoid false detection of inactivity.
+        self.time_last_server_active_packet = now
+        self.time_last_client_packet = None
+
+    def reset(self, now):
+        self.time_last_server_active_packet = now
+        self.time_last_client_packet = None
+        self.unanswered_client_messages = 0
+
+    def client_active(self, now):
+        # Whether the server is expected to send packets.
+        return (
+            self.time_last_client_packet is not None
+            and now - self.time_last_client_packet < self.client_window
+        )
+
+    def server_active(self, now):
+        self.time_last_server_active_packet = now
+        self.unanswered_client_messages = 0
+
+    def client_packet(self, now):
+        # Only called for classified Pitboss messages, see protocol.py
+        if not self.client_active(now):
+            self.unanswered_client_messages = 0
+        self.unanswered_client_messages += 1
+        self.time_last_client_packet = now
+
+    def is_frozen(self, now):
+        return (
+            self.client_active(now)
+            and self.unanswered_client_messages >= self.client_messages
+            and now - self.time_last_server_active_packet > self.reply_timeout
+        )
+
+
+class LivenessScheduler:
+    # Evaluates the liveness of all games at a fixed cadence, independent of
+    # how many clients are connected and whether client packets arrive.
+    # The revive actions are started on a thread per game, so a hanging
+    # action does not delay the checks of the other games.
+    def __init__(self, games, interval=5, clock=None):
+        self._games = list(games)
+        self.interval = interval
+        clock = clock or Clock()
+        clock.call_every(interval, self.check, "liveness scheduler")
+
+    def check(self, now):
+        for game in self._games:
+            game.update_thresholds()
+            if game.liveness.is_frozen(now):
+                logger.debug(f"game {game.game_id} - detected no network reply.")
+                game.no_network_reply(now)
@@ -1,102 +1,433 @@
+import gzip
 import logging
+import os
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
 
 import click_log
-import pkg_resources
-from prometheus_client import Counter, Gauge, Info, start_http_server
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.core import (
+    REGISTRY,
+    CounterMetricFamily,
+    GaugeMetricFamily,
+    HistogramMetricFamily,
+    InfoMetricFamily,
+)
+
+from .api import parse_address
+from .protocol import UNKNOWN, MessageClass
 
 logger = logging.getLogger(__name__)
 click_log.basic_config(logger)
 
-packets_total = Counter(
-    "civpb_watchdog_packets_total",
-    "Number of observed packets by the Civilization 4 Pitboss watchdog",
-    labelnames=("game", "direction"),
-)
-packets_bytes_total = Counter(
-    "civpb_watchdog_packets_bytes_total",
-    "Size of observed packets by the Civilization 4 Pitboss watchdog",
-    labelnames=("game", "direction"),
-)
-connections_concurrent = Gauge(
-    "civpb_watchdog_connections_active",
-    "Number of active connections observed by the Civilization 4 Pitboss watchdog",
-    labelnames=("game",),
-)
-connections_total = Counter(
-    "civpb_watchdog_connections_total",
-    "Number of connections that were established by the Civilization 4 Pitboss watchdog",
-    ("game",),
-)
-disconnects_total = Counter(
-    "civpb_watchdog_forced_disconnects_total",
-    "Number of times a connection was forcibly disconnected by the Civilization 4 Pitboss watchdog",
-    ("game",),
-)
-revives_total = Counter(
-    "civpb_watchdog_game_revives_total",
-    "Number of times a game revive was attempted",
-    ("game", "strategy"),
-)
+# The metrics are plain attributes of GameMetrics and ProcessMetrics and
+# are only converted to the exposition format by the WatchdogCollector.
+# Updating them is an attribute increment without any lock, each value has
+# a single writer thread. Readers may see slightly outdated values.
 
-capture_errors_total = Counter(
-    "civpb_watchdog_capture_errors_total",
-    "Number of capture errors",
-)
+QUEUE_LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0)
+
+# game_id -> GameMetrics of all games of this process
+_games = {}
+
+
+class ProcessMetrics:
+    # Metrics of the watchdog that are not specific to a game
+    def __init__(self):
+        self.capture_errors = 0
+        self.time_to_first_packet = None
+
+
+process_metrics = ProcessMetrics()
+
+
+def package_version():
+    # importlib.metadata only reads the installed metadata, opposed to
+    # pkg_resources, which scans all installed distributions on import.
+    try:
+        from importlib.metadata import PackageNotFoundError, version
+    except ImportError:
+        from importlib_metadata import PackageNotFoundError, version
+    try:
+        return version("civ4-mp.pb-watchdog")
+    except PackageNotFoundError:
+        return "unknown"
 
-info = Info("civpb_watchdog", "Civilization 4 Pitboss watchdog version information")
-info.info(
-    {
-        # https://stackoverflow.com/a/2073599/620382
-        "version": pkg_resources.require("civ4-mp.pb-watchdog")[0].version,
-    }
-)
+
+_version = package_version()
+
+
+def process_start_time():
+    # Start time of this process as unix timestamp, so the time spent on
+    # interpreter startup and imports is included.
+    try:
+        with open("/proc/self/stat") as f:
+            # The command name may contain spaces, skip it.
+            stat = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/stat") as f:
+            for line in f:
+                if line.startswith("btime"):
+                    boot_time = float(line.split()[1])
+                    break
+            else:
+                return None
+        # starttime is the 22nd field, the first two were skipped above.
+        return boot_time + int(stat[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def first_packet(now=None):
+    now = time.time() if now is None else now
+    start = process_start_time()
+    if start is None:
+        return
+    elapsed = now - start
+    process_metrics.time_to_first_packet = elapsed
+    logger.info(f"Captured first packet {elapsed:.2f} seconds after process start.")
 
 
 class GameMetrics:
     def __init__(self, game_id):
-        self._packets_out = packets_total.labels(game=game_id, direction="out")
-        self._packets_in = packets_total.labels(game=game_id, direction="in")
-        self._packets_out_bytes = packets_bytes_total.labels(
-            game=game_id, direction="out"
-        )
-        self._packets_in_bytes = packets_bytes_total.labels(
-            game=game_id, direction="in"
-        )
+        self.game_id = game_id
+        self.packets_out = 0
+        self.packets_in = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        # Packets per MessageClass
+        self.messages_out = [0] * len(MessageClass)
+        self.messages_in = [0] * len(MessageClass)
+        self.connections_active = 0
+        self.connections_total = 0
+        self.forced_disconnects = 0
+        # Flows put on probation, probation flows that lost their slot to
+        # another flow and connections evicted from a full registry
+        self.probation_flows = 0
+        self.probation_displaced = 0
+        self.connections_evicted = 0
+        # strategy -> number of revives
+        self.revives = {}
+        self.packet_limit = None
+        self.freeze_timeout = None
+        self.baseline_stray_packets = None
+        self.baseline_reply_gap = None
+        # Only counted for games with their own worker queue. Each counter
+        # is only written by one thread, the capture thread enqueues and
+        # the worker dequeues, so the queue itself is never locked here.
+        self.queued = False
+        self.queue_enqueued = 0
+        self.queue_dequeued = 0
+        self.queue_dropped = 0
+        # Non-cumulative counts, the last one is for +Inf
+        self.queue_latency_buckets = [0] * (len(QUEUE_LATENCY_BUCKETS) + 1)
+        self.queue_latency_sum = 0.0
+        self.queue_latency_budget_exceeded = 0
+        _games[game_id] = self
 
-        self._connections_concurrent = connections_concurrent.labels(game=game_id)
-        self._connections_total = connections_total.labels(game=game_id)
-        self._disconnects_total = disconnects_total.labels(game=game_id)
-        self._game = game_id
+    def send(self, size, message_class=UNKNOWN):
+        self.packets_out += 1
+        self.bytes_out += size
+        self.messages_out[message_class] += 1
 
-    def send(self, size):
-        self._packets_out.inc()
-        self._packets_out_bytes.inc(size)
-
-    def recv(self, size):
-        self._packets_in.inc()
-        self._packets_in_bytes.inc(size)
+    def recv(self, size, message_class=UNKNOWN):
+        self.packets_in += 1
+        self.bytes_in += size
+        self.messages_in[message_class] += 1
 
     def connect(self):
-        self._connections_total.inc()
-        self._connections_concurrent.inc()
+        self.connections_total += 1
+        self.connections_active += 1
 
     def disconnect(self):
-        self._connections_concurrent.dec()
+        self.connections_active -= 1
+
+    def probation_flow(self):
+        self.probation_flows += 1
+
+    def probation_displace(self):
+        self.probation_displaced += 1
+
+    def evict(self):
+        self.connections_evicted += 1
 
     def force_disconnect(self):
-        self._disconnects_total.inc()
+        self.forced_disconnects += 1
 
     def revive(self, strategy):
-        revives_total.labels(game=self._game, strategy=strategy).inc()
+        self.revives[strategy] = self.revives.get(strategy, 0) + 1
 
+    def thresholds(self, packet_limit, freeze_timeout):
+        self.packet_limit = packet_limit
+        self.freeze_timeout = freeze_timeout
 
-def start_metric_server(spec):
-    try:
-        addr, port = spec.split(":")
-        port = int(port)
-    except ValueError:
-        addr = spec
-        port = 9146
+    def baseline(self, stray_packets, reply_gap):
+        if stray_packets is not None:
+            self.baseline_stray_packets = stray_packets
+        if reply_gap is not None:
+            self.baseline_reply_gap = reply_gap
+
+    def track_queue(self):
+        self.queued = True
+
+    def enqueue(self):
+        self.queue_enqueued += 1
+
+    def dequeue(self):
+        self.queue_dequeued += 1
+
+    def queue_drop(self):
+        self.queue_dropped += 1
+
+    def queue_latency(self, seconds, over_budget):
+        self.queue_latency_buckets[bisect_left(QUEUE_LATENCY_BUCKETS, seconds)] += 1
+        self.queue_latency_sum += seconds
+        if over_budget:
+            self.queue_latency_budget_exceeded += 1
+
+
+class WatchdogCollector:
+    # Builds the metric families from the plain counters of all games.
+    def collect(self):
+        games = list(_games.values())
+        yield InfoMetricFamily(
+            "civpb_watchdog",
+            "Civilization 4 Pitboss watchdog version information",
+            value={"version": _version},
+        )
+
+        def family(cls, name, documentation, attribute, labels=("game",)):
+            metric = cls(name, documentation, labels=labels)
+            for game in games:
+                value = getattr(game, attribute)
+                if value is not None:
+                    metric.add_metric((game.game_id,), value)
+            return metric
+
+        packets = CounterMetricFamily(
+            "civpb_watchdog_packets",
+            "Number of observed packets by the Civilization 4 Pitboss watchdog",
+            labels=("game", "direction"),
+        )
+        packets_bytes = CounterMetricFamily(
+            "civpb_watchdog_packets_bytes",
+            "Size of observed packets by the Civilization 4 Pitboss watchdog",
+            labels=("game", "direction"),
+        )
+        messages = CounterMetricFamily(
+            "civpb_watchdog_messages",
+            "Number of observed packets by Pitboss message type",
+            labels=("game", "direction", "type"),
+        )
+        revives = CounterMetricFamily(
+            "civpb_watchdog_game_revives",
+            "Number of times a game revive was attempted",
+            labels=("game", "strategy"),
+        )
+        queue_depth = GaugeMetricFamily(
+            "civpb_watchdog_queue_depth",
+            "Number of packets waiting in the processing queue of a game",
+            labels=("game",),
+        )
+        queue_latency = HistogramMetricFamily(
+            "civpb_watchdog_queue_latency_seconds",
+            "Time packets of a game spent waiting in the processing queue",
+            labels=("game",),
+        )
+        for game in games:
+            packets.add_metric((game.game_id, "out"), game.packets_out)
+            packets.add_metric((game.game_id, "in"), game.packets_in)
+            packets_bytes.add_metric((game.game_id, "out"), game.bytes_out)
+            packets_bytes.add_metric((game.game_id, "in"), game.bytes_in)
+            for message_class in MessageClass:
+                name = message_class.name.lower()
+                messages.add_metric(
+                    (game.game_id, "out", name), game.messages_out[message_class]
+                )
+                messages.add_metric(
+                    (game.game_id, "in", name), game.messages_in[message_class]
+                )
+            for strategy, count in list(game.revives.items()):
+                revives.add_metric((game.game_id, strategy), count)
+            if not game.queued:
+                continue
+            queue_depth.add_metric(
+                (game.game_id,), max(0, game.queue_enqueued - game.queue_dequeued)
+            )
+            buckets = []
+            total = 0
+            for bound, count in zip(
+                QUEUE_LATENCY_BUCKETS + (float("inf"),), game.queue_latency_buckets
+            ):
+                total += count
+                buckets.append((str(bound) if bound != float("inf") else "+Inf", total))
+            queue_latency.add_metric((game.game_id,), buckets, game.queue_latency_sum)
+        yield packets
+        yield packets_bytes
+        yield messages
+        yield family(
+            GaugeMetricFamily,
+            "civpb_watchdog_connections_active",
+            "Number of active connections observed by the Civilization 4 Pitboss watchdog",
+            "connections_active",
+        )
+        yield family(
+            CounterMetricFamily,
+            "civpb_watchdog_connections",
+            "Number of connections that were established by the Civilization 4 Pitboss watchdog",
+            "connections_total",
+        )
+        yield family(
+            CounterMetricFamily,
+            "civpb_watchdog_probation_flows",
+            "Number of new flows that were put on probation until packets in both directions are seen",
+            "probation_flows",
+        )
+        yield family(
+            CounterMetricFamily,
+            "civpb_watchdog_probation_displaced",
+            "Number of flows on probation that were replaced by another flow in the fixed-size table",
+            "probation_displaced",
+        )
+        yield family(
+            CounterMetricFamily,
+            "civpb_watchdog_connections_evicted",
+            "Number of connections that were evicted because the registry was full",
+            "connections_evicted",
+        )
+        yield family(
+            CounterMetricFamily,
+            "civpb_watchdog_forced_disconnects",
+            "Number of times a connection was forcibly disconnected by the Civilization 4 Pitboss watchdog",
+            "forced_disconnects",
+        )
+        yield revives
+        yield queue_depth
+        yield family(
+            CounterMetricFamily,
+            "civpb_watchdog_queue_dropped_packets",
+            "Number of packets dropped because the processing queue of a game was full",
+            "queue_dropped",
+        )
+        yield queue_latency
+        yield family(
+            CounterMetricFamily,
+            "civpb_watchdog_queue_latency_budget_exceeded",
+            "Number of packets of a game that waited longer than the latency budget",
+            "queue_latency_budget_exceeded",
+        )
+        yield family(
+            GaugeMetricFamily,
+            "civpb_watchdog_packet_limit",
+            "Number of stray packets after which a client of a game is disconnected",
+            "packet_limit",
+        )
+        yield family(
+            GaugeMetricFamily,
+            "civpb_watchdog_freeze_timeout_seconds",
+            "Time without active server packets after which a game is considered frozen",
+            "freeze_timeout",
+        )
+        yield family(
+            GaugeMetricFamily,
+            "civpb_watchdog_baseline_stray_packets_p99",
+            "Learned 99th percentile of the number of server packets until a client replies during uploads",
+            "baseline_stray_packets",
+        )
+        yield family(
+            GaugeMetricFamily,
+            "civpb_watchdog_baseline_reply_gap_seconds",
+            "Learned 99.9th percentile of the time between active server packets while clients are connected",
+            "baseline_reply_gap",
+        )
+        yield CounterMetricFamily(
+            "civpb_watchdog_capture_errors",
+            "Number of capture errors",
+            value=process_metrics.capture_errors,
+        )
+        if process_metrics.time_to_first_packet is not None:
+            yield GaugeMetricFamily(
+                "civpb_watchdog_time_to_first_packet_seconds",
+                "Time from the start of the watchdog process until the first packet was captured",
+                value=process_metrics.time_to_first_packet,
+            )
+
+
+REGISTRY.register(WatchdogCollector())
+
+
+class TopClientsCollector:
+    # Only exports the current top clients per game, so the number of series
+    # stays bounded regardless of how many clients were seen.
+    def __init__(self, top_clients):
+        self._top_clients = top_clients
+
+    def collect(self):
+        family = GaugeMetricFamily(
+            "civpb_watchdog_top_client_bytes",
+            "Approximate traffic of the clients with the most traffic per game",
+            labels=("game", "client"),
+        )
+        for game_id, clients in self._top_clients().items():
+            for client, count, error in clients:
+                family.add_metric((game_id, client), count)
+        yield family
+
+
+def register_top_clients(top_clients):
+    REGISTRY.register(TopClientsCollector(top_clients))
+
+
+class ExpositionCache:
+    # Renders the metrics at most once per interval, so the cost does not
+    # depend on the number of scrapes. The gzip variant is compressed on
+    # the first request that accepts it.
+    def __init__(self, registry=REGISTRY, interval=1.0):
+        self._registry = registry
+        self.interval = interval
+        self._lock = Lock()
+        self._rendered = None
+        self._body = b""
+        self._gzipped = None
+
+    def get(self, gzipped=False, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            if self._rendered is None or now - self._rendered >= self.interval:
+                self._body = generate_latest(self._registry)
+                self._gzipped = None
+                self._rendered = now
+            if not gzipped:
+                return self._body
+            if self._gzipped is None:
+                self._gzipped = gzip.compress(self._body, compresslevel=6)
+            return self._gzipped
+
+
+def start_metric_server(spec, interval=1.0):
+    addr, port = parse_address(spec, 9146)
+    cache = ExpositionCache(interval=interval)
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            gzipped = "gzip" in self.headers.get("Accept-Encoding", "")
+            body = cache.get(gzipped)
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE_LATEST)
+            # The body depends on Accept-Encoding, also for caches.
+            self.send_header("Vary", "Accept-Encoding")
+            if gzipped:
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug("%s - %s", self.address_string(), format % args)
 
     logger.info(f"Starting prometheus server on {addr}:{port}")
-    start_http_server(port=port, addr=addr)
+    server = ThreadingHTTPServer((addr, port), Handler)
+    server.daemon_threads = True
+    # As a daemon thread, this will be cleaned up automatically when the main program ends.
+    Thread(target=server.serve_forever, name="metrics server", daemon=True).start()
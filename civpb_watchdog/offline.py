@@ -0,0 +1,71 @@
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from .events import EventType, event_log
+
+logger = logging.getLogger(__name__)
+
+
+class Summary:
+    # Collects the events of the analysis of a single capture file. It is
+    # subscribed synchronously, because the queue of a sink drops events
+    # under load and the report must be complete.
+    def __init__(self):
+        self.counts = {}
+        self.actions = []
+
+    def __call__(self, event):
+        counts = self.counts.setdefault(event.game, {})
+        counts[event.type.value] = counts.get(event.type.value, 0) + 1
+        if event.type in (EventType.FORCED_DISCONNECT, EventType.REVIVE):
+            self.actions.append(event.to_dict())
+
+
+def analyze_file(path, watchdog_args):
+    # Runs in a worker process, so everything must be created here.
+    from .watchdog import Watchdog
+
+    summary = Summary()
+    event_log.subscribe(summary)
+    try:
+        watchdog = Watchdog(**watchdog_args, offline=True)
+        result = watchdog.analyze_file(path)
+    finally:
+        event_log.unsubscribe(summary)
+    result["file"] = path
+    result["games"] = summary.counts
+    result["actions"] = summary.actions
+    return result
+
+
+def merge_results(results):
+    merged = {"files": [], "packets": 0, "games": {}, "actions": []}
+    for result in results:
+        merged["files"].append(
+            {key: result[key] for key in ("file", "packets", "start", "end")}
+        )
+        merged["packets"] += result["packets"]
+        for game_id, counts in result["games"].items():
+            merged_counts = merged["games"].setdefault(game_id, {})
+            for event_type, count in counts.items():
+                merged_counts[event_type] = merged_counts.get(event_type, 0) + count
+        for action in result["actions"]:
+            merged["actions"].append(dict(action, file=result["file"]))
+    merged["actions"].sort(key=lambda action: action["ts"])
+    return merged
+
+
+def analyze_files(paths, watchdog_args, jobs=None):
+    # Every file is analyzed independently with its own game state. Fresh
+    # interpreters are used for the workers, so no threads or sinks of this
+    # process are inherited.
+    if len(paths) == 1 or jobs == 1:
+        results = [analyze_file(path, watchdog_args) for path in paths]
+    else:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=jobs, mp_context=context) as executor:
+            results = list(
+                executor.map(analyze_file, paths, [watchdog_args] * len(paths))
+            )
+    return merge_results(results)
@@ -0,0 +1,127 @@
+import socket
+import struct
+
+# Minimal parser for the UDP packets of the Pitboss servers. This avoids the
+# dissection of every packet by scapy. Addresses are returned packed, i.e.,
+# as 4 bytes for IPv4 and 16 bytes for IPv6.
+
+# https://www.tcpdump.org/linktypes.html
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+LINKTYPE_LINUX_SLL2 = 276
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86DD
+ETHERTYPE_IP = (ETHERTYPE_IPV4, ETHERTYPE_IPV6)
+ETHERTYPE_VLAN = (0x8100, 0x88A8)
+
+# Address families of LINKTYPE_NULL: AF_INET, AF_INET6 (BSDs, Linux)
+NULL_AF_IP = (2, 10, 24, 28, 30)
+
+IPPROTO_UDP = 17
+IPPROTO_FRAGMENT = 44
+IPPROTO_AH = 51
+# Extension headers with the length in 8 byte units (without the first 8)
+IPV6_EXTENSION_HEADERS = (0, 43, 60)
+
+_ethertype = struct.Struct("!H")
+_udp_header = struct.Struct("!HHH")
+
+
+def _ip_offset(linktype, frame):
+    # Returns the offset of the IP header or None for unsupported frames.
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 12
+        (ethertype,) = _ethertype.unpack_from(frame, offset)
+        while ethertype in ETHERTYPE_VLAN:
+            offset += 4
+            (ethertype,) = _ethertype.unpack_from(frame, offset)
+        return offset + 2 if ethertype in ETHERTYPE_IP else None
+    if linktype in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+        return 0
+    if linktype == LINKTYPE_LINUX_SLL:
+        (ethertype,) = _ethertype.unpack_from(frame, 14)
+        return 16 if ethertype in ETHERTYPE_IP else None
+    if linktype == LINKTYPE_LINUX_SLL2:
+        (ethertype,) = _ethertype.unpack_from(frame, 0)
+        return 20 if ethertype in ETHERTYPE_IP else None
+    if linktype == LINKTYPE_NULL:
+        # The address family is stored in host byte order of the capturing host.
+        return 4 if frame[0] in NULL_AF_IP or frame[3] in NULL_AF_IP else None
+    return None
+
+
+def parse_frame(linktype, frame):
+    # Returns (src, sport, dst, dport, payload) for UDP packets, otherwise None.
+    try:
+        offset = _ip_offset(linktype, frame)
+        if offset is None:
+            return None
+        version = frame[offset] >> 4
+        if version == 4:
+            return _parse_ipv4(frame, offset)
+        if version == 6:
+            return _parse_ipv6(frame, offset)
+        return None
+    except (struct.error, IndexError):
+        # Truncated packet
+        return None
+
+
+def _parse_ipv4(frame, offset):
+    version_ihl = frame[offset]
+    if frame[offset + 9] != IPPROTO_UDP:
+        return None
+    # Only the first fragment contains the UDP header.
+    if (frame[offset + 6] & 0x1F) or frame[offset + 7]:
+        return None
+    (total_length,) = _ethertype.unpack_from(frame, offset + 2)
+    src = bytes(frame[offset + 12 : offset + 16])
+    dst = bytes(frame[offset + 16 : offset + 20])
+    udp = offset + (version_ihl & 0x0F) * 4
+    # The total length excludes the padding of short ethernet frames.
+    return _parse_udp(frame, udp, offset + total_length, src, dst)
+
+
+def _parse_ipv6(frame, offset):
+    (payload_length,) = _ethertype.unpack_from(frame, offset + 4)
+    next_header = frame[offset + 6]
+    src = bytes(frame[offset + 8 : offset + 24])
+    dst = bytes(frame[offset + 24 : offset + 40])
+    end = offset + 40 + payload_length
+    header = offset + 40
+    while next_header != IPPROTO_UDP:
+        if next_header in IPV6_EXTENSION_HEADERS:
+            length = (frame[header + 1] + 1) * 8
+        elif next_header == IPPROTO_FRAGMENT:
+            # Only the first fragment contains the UDP header.
+            if (frame[header + 2] << 8 | frame[header + 3]) & 0xFFF8:
+                return None
+            length = 8
+        elif next_header == IPPROTO_AH:
+            length = (frame[header + 1] + 2) * 4
+        else:
+            return None
+        next_header = frame[header]
+        header += length
+    return _parse_udp(frame, header, end, src, dst)
+
+
+def _parse_udp(frame, udp, end, src, dst):
+    sport, dport, length = _udp_header.unpack_from(frame, udp)
+    end = min(end, udp + length, len(frame))
+    return src, sport, dst, dport, bytes(frame[udp + 8 : end])
+
+
+def pack_address(address):
+    family = socket.AF_INET6 if ":" in address else socket.AF_INET
+    return socket.inet_pton(family, address)
+
+
+def format_address(packed):
+    family = socket.AF_INET6 if len(packed) == 16 else socket.AF_INET
+    return socket.inet_ntop(family, packed)
@@ -0,0 +1,125 @@
+import struct
+
+# Streaming reader for pcap and pcapng files. Yields (linktype, timestamp, frame)
+# without any dissection of the frames.
+
+PCAP_MAGIC_US = 0xA1B2C3D4
+PCAP_MAGIC_NS = 0xA1B23C4D
+PCAPNG_SHB = 0x0A0D0D0A
+PCAPNG_BYTE_ORDER_MAGIC = 0x1A2B3C4D
+PCAPNG_IDB = 0x00000001
+PCAPNG_PB = 0x00000002
+PCAPNG_SPB = 0x00000003
+PCAPNG_EPB = 0x00000006
+PCAPNG_OPT_IF_TSRESOL = 9
+
+
+class PcapError(Exception):
+    pass
+
+
+def read_packets(path):
+    with open(path, "rb", buffering=1 << 20) as f:
+        header = f.read(4)
+        if len(header) < 4:
+            raise PcapError(f"{path} is too short for a capture file")
+        (magic,) = struct.unpack("<I", header)
+        if magic == PCAPNG_SHB:
+            yield from _read_pcapng(f, header)
+        else:
+            yield from _read_pcap(f, header, path)
+
+
+def _read_pcap(f, magic_bytes, path):
+    for endian in "<>":
+        (magic,) = struct.unpack(endian + "I", magic_bytes)
+        if magic in (PCAP_MAGIC_US, PCAP_MAGIC_NS):
+            break
+    else:
+        raise PcapError(f"{path} is neither a pcap nor a pcapng file")
+    resolution = 1e-9 if magic == PCAP_MAGIC_NS else 1e-6
+    header = f.read(20)
+    if len(header) < 20:
+        return
+    (linktype,) = struct.unpack_from(endian + "I", header, 16)
+    linktype &= 0xFFFF
+
+    record = struct.Struct(endian + "IIII")
+    read = f.read
+    while True:
+        header = read(record.size)
+        if len(header) < record.size:
+            return
+        ts_sec, ts_frac, captured, _ = record.unpack(header)
+        frame = read(captured)
+        if len(frame) < captured:
+            # Truncated file, e.g., capture is still running
+            return
+        yield linktype, ts_sec + ts_frac * resolution, frame
+
+
+def _read_pcapng(f, magic_bytes):
+    endian = "<"
+    interfaces = []
+    timestamp = 0.0
+    header = magic_bytes + f.read(4)
+    while len(header) == 8:
+        block_type, block_length = struct.unpack(endian + "II", header)
+        if block_type == PCAPNG_SHB:
+            # The byte order of a section is defined by its first block.
+            rest = f.read(4)
+            if len(rest) < 4:
+                return
+            (byte_order,) = struct.unpack("<I", rest)
+            endian = "<" if byte_order == PCAPNG_BYTE_ORDER_MAGIC else ">"
+            (block_length,) = struct.unpack(endian + "I", header[4:])
+            body = rest + f.read(block_length - 12)
+            # Interface ids are local to a section.
+            interfaces = []
+        else:
+            body = f.read(block_length - 8)
+        if block_length < 12 or len(body) < block_length - 8:
+            return
+        # Without the trailing block length
+        body = body[:-4]
+
+        if block_type == PCAPNG_IDB:
+            (linktype,) = struct.unpack_from(endian + "H", body, 0)
+            interfaces.append((linktype, _if_tsresol(body, endian, 8)))
+        elif block_type == PCAPNG_EPB:
+            interface, ts_high, ts_low, captured = struct.unpack_from(
+                endian + "IIII", body, 0
+            )
+            linktype, resolution = interfaces[interface]
+            timestamp = ((ts_high << 32) | ts_low) * resolution
+            yield linktype, timestamp, body[20 : 20 + captured]
+        elif block_type == PCAPNG_SPB:
+            # Simple packets have no timestamp, use the one of the last packet.
+            (length,) = struct.unpack_from(endian + "I", body, 0)
+            linktype, _ = interfaces[0]
+            yield linktype, timestamp, body[4 : 4 + length]
+        elif block_type == PCAPNG_PB:
+            interface, _, ts_high, ts_low, captured = struct.unpack_from(
+                endian + "HHIII", body, 0
+            )
+            linktype, resolution = interfaces[interface]
+            timestamp = ((ts_high << 32) | ts_low) * resolution
+            yield linktype, timestamp, body[20 : 20 + captured]
+        header = f.read(8)
+
+
+def _if_tsresol(body, endian, offset):
+    resolution = 1e-6
+    while offset + 4 <= len(body):
+        code, length = struct.unpack_from(endian + "HH", body, offset)
+        if code == 0:
+            break
+        if code == PCAPNG_OPT_IF_TSRESOL and length >= 1:
+            value = body[offset + 4]
+            if value & 0x80:
+                resolution = 2.0 ** -(value & 0x7F)
+            else:
+                resolution = 10.0**-value
+        # Options are padded to 32 bits.
+        offset += 4 + (length + 3) // 4 * 4
+    return resolution
@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import re
+import signal
+import subprocess
+import tempfile
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Revive backends of the games. The script backend runs the scripts of bin/,
+# the native backend signals the processes of the games directly and only
+# runs civpb-confirm-popup, because it needs the X11 tools.
+
+_altroot = re.compile(r"ALTROOT=(\S+)")
+# Processes that start the game, but are not the game itself
+WRAPPERS = ("wine", "wine64", "xvfb-run")
+
+
+class ScriptBackend:
+    # Scripts that run longer than timeout seconds are killed, e.g.,
+    # xdotool waiting for a wedged Xvfb.
+    def __init__(self, script_path, timeout=60):
+        self.script_path = script_path
+        self.timeout = timeout
+
+    def _call(self, script, *args):
+        command = [os.path.join(self.script_path, script), *args]
+        try:
+            return subprocess.call(command, timeout=self.timeout) == 0
+        except subprocess.TimeoutExpired:
+            logger.warning(f"{script} did not finish within {self.timeout} seconds.")
+            return False
+
+    def popup_confirm(self, game):
+        return self._call("civpb-confirm-popup", game.game_id)
+
+    def restart_game(self, game, previous_save=False):
+        args = ["-p"] if previous_save else []
+        return self._call("civpb-kill", *args, game.game_id)
+
+    def stop_game(self, game):
+        return self._call("civpb-kill", "-s", game.game_id)
+
+
+class NativeBackend(ScriptBackend):
+    def __init__(self, script_path, proc="/proc"):
+        super().__init__(script_path)
+        self.processes = ProcessTable(proc)
+
+    def restart_game(self, game, previous_save=False):
+        pid = self.processes.game_pid(game.game_id)
+        if pid is None:
+            logger.warning(f"Can't find unique process of game {game.game_id}.")
+            return False
+        # Before the kill, so the restarted game already uses the previous
+        # save.
+        if previous_save:
+            try:
+                if not load_previous_save(game.path):
+                    logger.info(f"No previous save found for game {game.game_id}.")
+            except (OSError, ValueError) as e:
+                logger.warning(
+                    f"Can't switch game {game.game_id} to previous save: {e}"
+                )
+        logger.info(f"Kill game {game.game_id}, pid {pid}")
+        return _kill(pid)
+
+    def stop_game(self, game):
+        pid = self.processes.script_pid(game.game_id)
+        if pid is None:
+            logger.warning(f"Can't find unique xvfb-run of game {game.game_id}.")
+            return False
+        ppid, pgid = self.processes.parents(pid)
+        logger.info(
+            f"Kill startup script of game {game.game_id}, pid {ppid}, group {pgid}"
+        )
+        # The startup script first, so it does not restart the game. Never
+        # signal init or the own process group.
+        if ppid > 1 and not _kill(ppid):
+            return False
+        if pgid == os.getpgrp():
+            return _kill(pid)
+        return _kill(-pgid)
+
+
+def _kill(pid):
+    try:
+        if pid < 0:
+            os.killpg(-pid, signal.SIGKILL)
+        else:
+            os.kill(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # Already gone
+        pass
+    except OSError as e:
+        logger.warning(f"Failed to kill {pid}: {e}")
+        return False
+    return True
+
+
+class ProcessTable:
+    # Finds the processes of the games by the name of the ALTROOT directory
+    # in their command line, like civpb-kill. The pids are cached and only
+    # verified on a lookup, a full scan of /proc is only needed if the game
+    # was restarted.
+    def __init__(self, proc="/proc"):
+        self._proc = proc
+        self._lock = Lock()
+        # (ALTROOT name, is xvfb-run) -> pids of the game or its xvfb-run
+        self._pids = {}
+
+    def game_pid(self, game_id):
+        return self._lookup((game_id, False))
+
+    def script_pid(self, game_id):
+        return self._lookup((game_id, True))
+
+    def parents(self, pid):
+        # Returns (ppid, pgid) of the process.
+        with open(os.path.join(self._proc, str(pid), "stat"), "rb") as f:
+            stat = f.read()
+        # The command name may contain spaces and parentheses.
+        fields = stat[stat.rindex(b")") + 2 :].split()
+        return int(fields[1]), int(fields[2])
+
+    def _lookup(self, key):
+        # Returns the pid if the process is unique, like civpb-kill.
+        with self._lock:
+            pids = self._pids.get(key, ())
+            if len(pids) != 1 or self._classify(pids[0]) != key:
+                self._scan()
+                pids = self._pids.get(key, ())
+            return pids[0] if len(pids) == 1 else None
+
+    def _scan(self):
+        pids = {}
+        for entry in os.scandir(self._proc):
+            if not entry.name.isdigit():
+                continue
+            pid = int(entry.name)
+            key = self._classify(pid)
+            if key is not None:
+                pids.setdefault(key, []).append(pid)
+        self._pids = pids
+
+    def _classify(self, pid):
+        # Returns (ALTROOT name, is xvfb-run) for processes of games, else None.
+        try:
+            with open(os.path.join(self._proc, str(pid), "cmdline"), "rb") as f:
+                cmdline = f.read()
+        except OSError:
+            # Process ended
+            return None
+        args = cmdline.decode(errors="replace").split("\0")
+        command = " ".join(args)
+        if "Civ4BeyondSword" not in command:
+            return None
+        match = _altroot.search(command)
+        if match is None:
+            return None
+        # Windows path of wine, e.g., Z:\home\civpb\PBs\PB1
+        name = re.split(r"[\\/]", match.group(1).rstrip("\\/"))[-1]
+        wrappers = [os.path.basename(arg) for arg in args if arg]
+        if "xvfb-run" in wrappers[:2]:
+            return name, True
+        if any(wrapper in WRAPPERS for wrapper in wrappers):
+            return None
+        return name, False
+
+
+def load_previous_save(altroot):
+    # pbSettings["save"]["filename"] = pbSettings["save"]["previous_filename"]
+    # Returns False if there is no previous save.
+    path = os.path.join(altroot, "pbSettings.json")
+    with open(path, encoding="utf-8") as f:
+        settings = json.load(f)
+    save = settings.get("save", {})
+    if "previous_filename" not in save:
+        return False
+    save["filename"] = save.pop("previous_filename")
+    save.pop("folderIndex", None)
+    if "previous_folderIndex" in save:
+        save["folderIndex"] = save.pop("previous_folderIndex")
+
+    # Replace the file atomically, the game may read it at any time.
+    fd, tmp_path = tempfile.mkstemp(dir=altroot, prefix=".pbSettings.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(settings, f, indent=2)
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return True
@@ -0,0 +1,86 @@
+from enum import IntEnum, unique
+
+# Classification of the UDP payloads of Pitboss by the fefe header, the
+# length and the command byte after the header. The classes are looked up
+# in a table that is built once from SIGNATURES, so new signatures are
+# just data.
+#
+# Examples of payloads:
+#     fefe 640009, fefe 64000a                               (popup open)
+#     fefe 0000590009dcdc01, fefe 00005a000adcdc01           (popup open)
+#     fefe 00023b000bfdffffff01ffffffff143f02003d02000001    (idle)
+#     fefe 06 B (A+1)                                        (disconnect)
+
+HEADER = 0xFE
+# Longer payloads are always DATA
+MAX_LENGTH = 64
+
+
+@unique
+class MessageClass(IntEnum):
+    # No fefe header
+    UNKNOWN = 0
+    # Any other message of the game
+    DATA = 1
+    # Only payloads of these lengths are sent while the game hangs with a
+    # "save error" popup, so they do not show that the server is alive.
+    KEEPALIVE = 2
+    # Carry the two 16 bit numbers A and B (bytes 3-6) that are needed for
+    # a disconnect. A client that does not answer them anymore, e.g., because
+    # it is stuck in an upload, gets disconnected.
+    SEQUENCED = 3
+    # Closes the connection
+    DISCONNECT = 4
+
+
+# (class, payload lengths, commands or None for any command)
+SIGNATURES = (
+    (MessageClass.KEEPALIVE, (5, 10), None),
+    (MessageClass.SEQUENCED, (25, 37), None),
+    (MessageClass.DISCONNECT, (7,), (0x06,)),
+)
+
+
+def _build_table(signatures):
+    # length << 8 | command -> class
+    table = bytearray([MessageClass.DATA]) * (MAX_LENGTH << 8)
+    for message_class, lengths, commands in signatures:
+        for length in lengths:
+            for command in range(256) if commands is None else commands:
+                table[length << 8 | command] = message_class
+    return bytes(table)
+
+
+_table = _build_table(SIGNATURES)
+
+# Plain ints for the checks per packet, as the attribute access of the enum
+# is comparatively slow.
+UNKNOWN = int(MessageClass.UNKNOWN)
+DATA = int(MessageClass.DATA)
+KEEPALIVE = int(MessageClass.KEEPALIVE)
+SEQUENCED = int(MessageClass.SEQUENCED)
+
+
+def classify(payload, _table=_table):
+    # Returns the value of the MessageClass.
+    length = len(payload)
+    if length < 3 or payload[0] != HEADER or payload[1] != HEADER:
+        return UNKNOWN
+    if length >= MAX_LENGTH:
+        return DATA
+    return _table[length << 8 | payload[2]]
+
+
+def disconnect_message(payload):
+    # Fake message of the client that stops the upload of a SEQUENCED
+    # payload. Structure of content:
+    #     254 254 06 B (A+1) (7 bytes)
+    #
+    # First 2 bytes marks it as udp paket(?!)
+    # Thrid bytes is command (close connection to client)
+    #   B and A+1 are to 16 bit numbers where A and B
+    #   are content of "payload"
+    aHi, aLow = payload[3], payload[4]
+    bHi, bLow = payload[5], payload[6]
+    a_plus_1 = (aHi * 256 + aLow + 1) % 65536
+    return bytes([254, 254, 6, bHi, bLow, int(a_plus_1 / 256), (a_plus_1 % 256)])
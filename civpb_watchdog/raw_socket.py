@@ -0,0 +1,90 @@
+import logging
+import socket
+import struct
+from threading import Lock
+
+# Packets for sending fake client replies
+from .pyip import ip as pyip_ip
+from .pyip import udp as pyip_udp
+
+logger = logging.getLogger(__name__)
+
+# One raw socket per address family, created on first use and kept open.
+_sockets = {}
+_sockets_lock = Lock()
+
+_ipv6_header = struct.Struct("!IHBB16s16s")
+_udp_header = struct.Struct("!HHHH")
+
+
+def _checksum(data):
+    if len(data) % 2:
+        data += b"\0"
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    while total >> 16:
+        total = (total & 0xFFFF) + (total >> 16)
+    return ~total & 0xFFFF
+
+
+def _ipv4_udp_packet(src, sport, dst, dport, data):
+    upacket = pyip_udp.Packet()
+    upacket.sport = sport
+    upacket.dport = dport
+    upacket.data = data
+
+    ipacket = pyip_ip.Packet()
+    ipacket.src = src
+    ipacket.dst = dst
+    ipacket.df = 1
+    ipacket.ttl = 64
+    ipacket.p = 17
+
+    ipacket.data = pyip_udp.assemble(upacket, False)
+    return pyip_ip.assemble(ipacket, 1)
+
+
+def _ipv6_udp_packet(src, sport, dst, dport, data):
+    src = socket.inet_pton(socket.AF_INET6, src)
+    dst = socket.inet_pton(socket.AF_INET6, dst)
+    length = _udp_header.size + len(data)
+    # The UDP checksum is mandatory for IPv6, it includes a pseudo header.
+    pseudo_header = src + dst + struct.pack("!I3xB", length, socket.IPPROTO_UDP)
+    checksum = _checksum(
+        pseudo_header + _udp_header.pack(sport, dport, length, 0) + data
+    )
+    udp = _udp_header.pack(sport, dport, length, checksum or 0xFFFF) + data
+    # Version 6, no traffic class and flow label, hop limit 64
+    return _ipv6_header.pack(6 << 28, length, socket.IPPROTO_UDP, 64, src, dst) + udp
+
+
+def _get_socket(family):
+    sock = _sockets.get(family)
+    if sock is None:
+        with _sockets_lock:
+            sock = _sockets.get(family)
+            if sock is None:
+                # With IPPROTO_RAW, the IP header is included for both
+                # families on Linux.
+                sock = socket.socket(family, socket.SOCK_RAW, socket.IPPROTO_RAW)
+                _sockets[family] = sock
+    return sock
+
+
+def send_udp(src, sport, dst, dport, data):
+    # Sends a UDP packet with a spoofed source address.
+    if ":" in src:
+        family = socket.AF_INET6
+        raw_ip = _ipv6_udp_packet(src, sport, dst, dport, data)
+    else:
+        family = socket.AF_INET
+        raw_ip = _ipv4_udp_packet(src, sport, dst, dport, data)
+
+    try:
+        _get_socket(family).sendto(raw_ip, (dst, 0))
+    except socket.error as e:
+        logger.error("Raw packet could not be sent: {}".format(e))
+        # Recreate the socket on the next attempt.
+        with _sockets_lock:
+            sock = _sockets.pop(family, None)
+        if sock is not None:
+            sock.close()
@@ -0,0 +1,140 @@
+import logging
+from collections import namedtuple
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Revive actions of a game, see Game.revive
+ACTIONS = ("popup_confirm", "restart_current_save", "restart_old_save", "stop")
+
+# Conditions that must hold before a step is run, see Game.revive_condition
+CONDITIONS = ("no_uploads",)
+
+# The escalation of earlier versions: Each step is run at least 30 seconds
+# after the previous one as long as the server does not reply.
+DEFAULT_PIPELINE = (
+    {"action": "popup_confirm", "timeout": 30},
+    {"action": "restart_current_save", "timeout": 30},
+    {"action": "restart_old_save", "timeout": 30},
+    {"action": "stop", "timeout": 30},
+)
+
+STEP_DEFAULTS = {"timeout": 30, "retries": 0, "condition": None, "otherwise": "wait"}
+
+ReviveStep = namedtuple("ReviveStep", "action timeout condition otherwise")
+
+
+class RevivePipeline:
+    # The steps of the game config, compiled into a table. State i means
+    # that steps[:i] have been run and steps[i] is the next one. The last
+    # state has no step, nothing is done until the server is online again.
+    def __init__(self, steps):
+        expanded = []
+        for number, spec in enumerate(steps, 1):
+            step = _parse_step(number, spec)
+            # A retry is just another run of the same step.
+            expanded.extend([step] * (spec.get("retries", 0) + 1))
+        self.steps = tuple(expanded)
+
+        # Precomputed transitions: the next state after running a step and
+        # after its condition failed.
+        final = len(self.steps)
+        self.on_run = tuple(range(1, final + 1))
+        self.on_blocked = tuple(
+            i if step.otherwise == "wait" else i + 1
+            for i, step in enumerate(self.steps)
+        )
+
+    def __len__(self):
+        return len(self.steps)
+
+
+def _parse_step(number, spec):
+    unknown = set(spec) - set(STEP_DEFAULTS) - {"action"}
+    if unknown:
+        raise ValueError(f"Unknown keys in revive step {number}: {sorted(unknown)}")
+    values = dict(STEP_DEFAULTS)
+    values.update(spec)
+    if values.get("action") not in ACTIONS:
+        raise ValueError(
+            f"Revive step {number} needs an action of {', '.join(ACTIONS)}"
+        )
+    if values["condition"] is not None and values["condition"] not in CONDITIONS:
+        raise ValueError(f"Unknown condition in revive step {number}")
+    if values["otherwise"] not in ("wait", "skip"):
+        raise ValueError(f"otherwise of revive step {number} must be wait or skip")
+    timeout, retries = values["timeout"], values["retries"]
+    if isinstance(timeout, bool) or not isinstance(timeout, (int, float)):
+        raise ValueError(f"timeout of revive step {number} must be a number")
+    if isinstance(retries, bool) or not isinstance(retries, int):
+        raise ValueError(f"retries of revive step {number} must be an integer")
+    if timeout < 0 or retries < 0:
+        raise ValueError(f"Negative timeout or retries in revive step {number}")
+    return ReviveStep(
+        values["action"], values["timeout"], values["condition"], values["otherwise"]
+    )
+
+
+class ReviveStateMachine:
+    # Escalation state of a single game. The liveness scheduler asks for the
+    # next step while the server is frozen, the capture thread resets the
+    # state if the server replies again.
+    def __init__(self, pipeline, now):
+        self.pipeline = pipeline
+        self.lock = Lock()
+        self.state = 0
+        # Index of the last step that was run. Skipped steps advance the
+        # state, but are never run.
+        self.last_run = None
+        self.time_last_transition = now
+
+    @property
+    def step(self):
+        # The last step that was run, None if the server is fine.
+        last_run = self.last_run
+        return None if last_run is None else self.pipeline.steps[last_run]
+
+    def reset(self, now):
+        with self.lock:
+            self.state = 0
+            self.last_run = None
+            self.time_last_transition = now
+
+    def online(self, now):
+        # Returns the last step that was run if the server recovered from
+        # it.
+        with self.lock:
+            if self.state == 0:
+                return None
+            step = self.step
+            self.state = 0
+            self.last_run = None
+            self.time_last_transition = now
+            return step
+
+    def next_step(self, now, condition):
+        # Returns the step to run or None. The state is advanced before
+        # the step is run, so a slow action is never started twice.
+        pipeline = self.pipeline
+        with self.lock:
+            state = self.state
+            while state < len(pipeline):
+                step = pipeline.steps[state]
+                if now - self.time_last_transition < step.timeout:
+                    return None
+                if step.condition is None or condition(step.condition, now):
+                    self.last_run = state
+                    self.state = pipeline.on_run[state]
+                    self.time_last_transition = now
+                    return step
+                blocked = pipeline.on_blocked[state]
+                logger.debug(
+                    "Condition %s of revive step %s not met, %s.",
+                    step.condition,
+                    step.action,
+                    step.otherwise,
+                )
+                if blocked == state:
+                    return None
+                state = self.state = blocked
+            return None
@@ -0,0 +1,255 @@
+import random
+import time
+
+import click
+
+from .clock import VirtualClock
+from .events import EventType, event_log
+from .game import GameReviveStrategies
+from .packet import pack_address
+from .watchdog import Watchdog
+
+# Scripted Pitboss traffic in virtual time. Each scenario yields the packets
+# of a single game in time order and may react on the actions of the
+# watchdog, e.g., a frozen server recovers after the popup was confirmed.
+# Usage: python -m civpb_watchdog.simulation [SCENARIO]...
+
+SERVER_IP = pack_address("10.0.0.1")
+SERVER_PORT = 2056
+
+# Payloads of the message classes, see protocol.py
+ACTIVE = bytes.fromhex("fefe0101020304")  # DATA
+CLIENT = bytes.fromhex("fefe0101020304")
+POPUP = (bytes.fromhex("fefe640009"), bytes.fromhex("fefe0000590009dcdc01"))
+UPLOAD = bytes.fromhex("fefe00023b000b") + bytes(30)  # SEQUENCED, 37 bytes
+
+
+class Simulation:
+    def __init__(self, game_config=None, packet_limit=2000):
+        self.clock = VirtualClock()
+        self.watchdog = Watchdog(
+            ["10.0.0.1"],
+            [f"/simulation/PB1:{SERVER_PORT}"],
+            packet_limit,
+            script_path="",
+            dump_packets=None,
+            game_config=game_config,
+            dry_run=True,
+            clock=self.clock,
+        )
+        self.game = self.watchdog._games[SERVER_PORT]
+        self.packets = 0
+        # strategy -> number of revives. The revive metrics do not count the
+        # dry runs, so the events are counted.
+        self.revives = {}
+
+    def _event(self, event):
+        if event.type == EventType.REVIVE and event.game == self.game.game_id:
+            strategy = event.fields["strategy"]
+            self.revives[strategy] = self.revives.get(strategy, 0) + 1
+
+    def run(self, scenario, start=0.0):
+        event_log.subscribe(self._event)
+        try:
+            self.watchdog.start(start)
+            for now, to_server, client, payload in scenario(self, start):
+                client_ip, client_port = client
+                if to_server:
+                    self.watchdog.replay_packet(
+                        client_ip, client_port, SERVER_IP, SERVER_PORT, payload, now
+                    )
+                else:
+                    self.watchdog.replay_packet(
+                        SERVER_IP, SERVER_PORT, client_ip, client_port, payload, now
+                    )
+                self.packets += 1
+        finally:
+            event_log.unsubscribe(self._event)
+        return self.result()
+
+    def revived(self, strategy):
+        return self.revives.get(strategy, 0) > 0
+
+    def result(self):
+        metrics = self.game.metrics
+        return {
+            "revives": dict(self.revives),
+            "forced_disconnects": metrics.forced_disconnects,
+            "connections": metrics.connections_total,
+            "latest_strategy": self.game.latest_strategy.name,
+        }
+
+
+def client(index):
+    return pack_address(f"10.1.{index // 256}.{index % 256}"), 40000 + index
+
+
+def exchange(now, clients, server_payload=ACTIVE):
+    # Every client sends a packet and gets an answer, slightly staggered.
+    for i, c in enumerate(clients):
+        yield now + i * 0.01, True, c, CLIENT
+        if server_payload is not None:
+            yield now + i * 0.01 + 0.005, False, c, server_payload
+
+
+def idle(start, end, clients, interval=5):
+    now = start
+    while now < end:
+        yield from exchange(now, clients)
+        now += interval
+
+
+def upload_stall(sim, start, hours=2):
+    # A client vanishes during the download of the save, the server keeps
+    # sending upload packets until the client is disconnected.
+    clients = [client(i) for i in range(3)]
+    end = start + hours * 3600
+    stall = start + 1800
+    yield from idle(start, stall, clients)
+    now = stall
+    while now < end and not sim.game.metrics.forced_disconnects:
+        yield from exchange(now, clients[:2])
+        for i in range(250):
+            yield now + 0.02 + i * 0.02, False, clients[2], UPLOAD
+        now += 5
+    yield from idle(now, end, clients[:2])
+
+
+upload_stall.expected = {"forced_disconnects": 1, "revives": {}}
+
+
+def save_error_popup(sim, start, hours=2):
+    # The server only sends keep alive packets while a save error popup is
+    # open, until the popup is confirmed.
+    clients = [client(i) for i in range(2)]
+    end = start + hours * 3600
+    popup = start + 1200
+    yield from idle(start, popup, clients)
+    now = popup
+    while now < end and not sim.revived("popup_confirm"):
+        yield from exchange(now, clients, POPUP[int(now) % 2])
+        now += 5
+    yield from idle(now, end, clients)
+
+
+save_error_popup.expected = {
+    "forced_disconnects": 0,
+    "revives": {"popup_confirm": 1},
+    "latest_strategy": GameReviveStrategies.NO_STRATEGY.name,
+}
+
+
+def server_crash(sim, start, hours=2):
+    # The server process hangs without sending anything, only a restart
+    # helps. The restarted game needs a minute until clients can connect.
+    clients = [client(i) for i in range(2)]
+    end = start + hours * 3600
+    crash = start + 1200
+    yield from idle(start, crash, clients)
+    now = crash
+    while now < end and not sim.revived("restart_current_save"):
+        yield from exchange(now, clients, None)
+        now += 5
+    yield from idle(now + 60, end, clients)
+
+
+server_crash.expected = {
+    "forced_disconnects": 0,
+    "revives": {"popup_confirm": 1, "restart_current_save": 1},
+    "latest_strategy": GameReviveStrategies.NO_STRATEGY.name,
+}
+
+
+def frozen_at_start(sim, start, hours=1):
+    # The server is already frozen when the watchdog starts, so it never
+    # answers any client. The players reconnect from new ports every
+    # minute, until the restarted game answers them.
+    end = start + hours * 3600
+    now = start
+    while now < end and not sim.revived("restart_current_save"):
+        attempt = int(now - start) // 60
+        clients = [(ip, port + attempt) for ip, port in map(client, range(2))]
+        yield from exchange(now, clients, None)
+        now += 5
+    yield from idle(now + 60, end, [client(i) for i in range(2)])
+
+
+frozen_at_start.expected = {
+    "forced_disconnects": 0,
+    "revives": {"popup_confirm": 1, "restart_current_save": 1},
+    "latest_strategy": GameReviveStrategies.NO_STRATEGY.name,
+}
+
+
+def client_churn(sim, start, hours=6, seed=4):
+    # Every 30 seconds a client joins and stays up to 10 minutes. Neither
+    # the server is revived nor a client disconnected.
+    rng = random.Random(seed)
+    end = start + hours * 3600
+    sessions = []  # (leave, client)
+    index = 0
+    now = start
+    while now < end:
+        if int(now - start) % 30 == 0:
+            sessions.append((now + rng.uniform(60, 600), client(index)))
+            index += 1
+        sessions = [(leave, c) for leave, c in sessions if leave > now]
+        yield from exchange(now, [c for _, c in sessions])
+        now += 5
+
+
+client_churn.expected = {
+    "forced_disconnects": 0,
+    "revives": {},
+    "connections": 720,
+}
+
+
+SCENARIOS = {
+    scenario.__name__: scenario
+    for scenario in (
+        upload_stall,
+        save_error_popup,
+        server_crash,
+        frozen_at_start,
+        client_churn,
+    )
+}
+
+
+def run_scenario(name):
+    # Returns (result, failed expectations, simulated seconds, wall seconds)
+    scenario = SCENARIOS[name]
+    simulation = Simulation()
+    start = time.perf_counter()
+    result = simulation.run(scenario)
+    elapsed = time.perf_counter() - start
+    failed = {
+        key: value for key, value in scenario.expected.items() if result[key] != value
+    }
+    result["packets"] = simulation.packets
+    return result, failed, simulation.clock.time(), elapsed
+
+
+@click.command()
+@click.argument("scenarios", nargs=-1, type=click.Choice(list(SCENARIOS)))
+def main(scenarios):
+    """Runs scripted Pitboss scenarios against the watchdog in virtual time."""
+    ok = True
+    for name in scenarios or SCENARIOS:
+        result, failed, simulated, elapsed = run_scenario(name)
+        ok = ok and not failed
+        click.echo(
+            f"{name}: {'FAIL' if failed else 'ok'} - {simulated / 3600:.1f}h "
+            f"with {result['packets']} packets in {elapsed * 1000:.0f}ms, "
+            f"revives {result['revives']}, "
+            f"forced disconnects {result['forced_disconnects']}"
+        )
+        for key, expected in failed.items():
+            click.echo(f"  {key}: expected {expected}, got {result[key]}")
+    if not ok:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -17,6 +17,7 @@
 #   sudo setcap cap_net_raw=+ep python3
 #
 
+import json
 import logging
 import sys
 import time
@@ -26,14 +27,27 @@ from datetime import datetime
 import click
 import click_config_file
 import click_log
-# Packet(s) for sniffing
-import scapy
-import toml
-from scapy.all import IP, UDP, sniff
 
+from .api import ApiServer
+from .capture import Capture
+from .clock import Clock, VirtualClock
 from .connection_registry import ConnectionRegistry
+from .events import JournaldSink, JsonLinesSink, event_log
 from .game import Game
-from .metrics import capture_errors_total, start_metric_server
+from .game_worker import GameWorker
+from .health import Backoff, HealthMonitor
+from .history import HistorySink
+from .liveness import LivenessScheduler
+from .metrics import (
+    first_packet,
+    process_metrics,
+    register_top_clients,
+    start_metric_server,
+)
+from .offline import analyze_files
+from .packet import format_address, pack_address, parse_frame
+from .pcap import read_packets
+from .process import NativeBackend, ScriptBackend
 
 # Use root logger here, so other loggers inherit the configuration
 logger = logging.getLogger()
@@ -43,117 +57,325 @@ click_log.basic_config(logger)
 class Watchdog:
     def __init__(
         self,
-        ip_address,
+        ip_addresses,
         game_args,
         packet_limit,
         script_path,
         dump_packets,
+        isolate_games=False,
+        queue_size=10000,
+        latency_budget=1.0,
+        top_clients=10,
+        max_connections=1024,
+        probation_size=256,
+        freeze_timeout=18,
+        adaptive_thresholds=False,
+        game_config=None,
+        dry_run=False,
+        revive_backend="script",
+        offline=False,
+        clock=None,
     ):
         self._script_path = script_path
+        self._top_clients = top_clients
         self._dump_packets = dump_packets
 
-        self._connections = ConnectionRegistry(packet_limit)
+        # For capture files, there are no background threads and no actions
+        # are taken, see analyze_file. The periodic checks are driven by the
+        # packet timestamps with a virtual clock.
+        if clock is None:
+            clock = VirtualClock() if offline else Clock()
+        self._clock = clock
+        self._cleanup_interval = 60
+        self.health = None
+
+        # Command line values, the game config can override them per game.
+        defaults = {
+            "packet_limit": packet_limit,
+            "freeze_timeout": freeze_timeout,
+            "adaptive": adaptive_thresholds,
+            "queue_size": queue_size,
+            "latency_budget": latency_budget,
+        }
+        # Shared by all games, so a single scan of /proc finds all of them.
+        if revive_backend == "native":
+            backend = NativeBackend(script_path)
+        else:
+            backend = ScriptBackend(script_path)
         self._games = {}
         for game_arg in game_args:
-            game = Game(game_arg, self)
+            game = Game(
+                game_arg,
+                script_path,
+                dry_run=dry_run or offline,
+                defaults=defaults,
+                game_config=game_config,
+                backend=backend,
+                clock=clock,
+            )
             self._games[game.port] = game
 
-        self._ip_address = ip_address
+        # Maps the server port to the packet handler of the game.
+        # Either all games share a single registry and are processed on the
+        # capture thread, or each game has its own registry and worker thread.
+        self._handlers = {}
+        self._registries = {}
+        if isolate_games and not offline:
+            # The limits are for the whole process, so they are split
+            # between the registries.
+            shares = len(self._games)
+            for port, game in self._games.items():
+                registry = ConnectionRegistry(
+                    cleanup_interval=self._cleanup_interval,
+                    heavy_clients_capacity=4 * top_clients,
+                    capacity=max(1, max_connections // shares),
+                    probation_size=max(1, probation_size // shares),
+                    clock=clock,
+                )
+                worker = GameWorker(game, registry)
+                self._handlers[port] = worker.handle_packet
+                self._registries[port] = registry
+        else:
+            registry = ConnectionRegistry(
+                cleanup_interval=self._cleanup_interval,
+                heavy_clients_capacity=4 * top_clients,
+                capacity=max_connections,
+                probation_size=probation_size,
+                clock=clock,
+            )
+            for port in self._games:
+                self._handlers[port] = registry.handle_packet
+                self._registries[port] = registry
+
+        self._liveness_scheduler = LivenessScheduler(self._games.values(), clock=clock)
 
-    def _handle_packet(self, pkt):
-        if not (IP in pkt and UDP in pkt):
+        self._ip_addresses = list(ip_addresses)
+        # Packed addresses for a cheap lookup per packet
+        self._server_addresses = frozenset(pack_address(a) for a in ip_addresses)
+        self._waiting_for_first_packet = True
+
+    def _handle_frame(self, linktype, now, frame):
+        if self._waiting_for_first_packet:
+            self._waiting_for_first_packet = False
+            first_packet()
+
+        parsed = parse_frame(linktype, frame)
+        if parsed is None:
             # May be true if some port scanner knocks on PBServer port?!
             # The current traffic filter prevent getting such packets here.
             return
+        self._handle_udp(*parsed, now)
 
-        ip = pkt[IP]
-        udp = pkt[UDP]
-        payload = udp.payload.original
-        now = pkt.time
-
+    def _handle_udp(self, src, sport, dst, dport, payload, now):
+        # Addresses are packed
         if self._dump_packets:
             self._dump_packets.write(
-                f"{now}|{ip.src}:{udp.sport}|{ip.dst}:{udp.dport}|{len(payload)}|{payload.hex()}\n"
+                f"{now}|{format_address(src)}:{sport}|{format_address(dst)}:{dport}|{len(payload)}|{payload.hex()}\n"
             )
 
-        with self._connections.lock:
-            try:
-                if ip.src == self._ip_address:
-                    game = self._games[udp.sport]
-                    self._connections.get(
-                        ip.dst, udp.dport, ip.src, udp.sport, now, game
-                    ).handle_server_to_client(payload, now)
-                elif ip.dst == self._ip_address:
-                    game = self._games[udp.dport]
-                    self._connections.get(
-                        ip.src, udp.sport, ip.dst, udp.dport, now, game
-                    ).handle_client_to_server(payload, now)
-                else:
-                    logger.warning(
-                        "PB server matches neither source ({}) nor destination ({})".format(
-                            ip.src, ip.dst
-                        )
-                    )
-            except KeyError:
-                logger.warning(
-                    "Observed packet with UDP port mismatch (ip.src: {}, sport: {}, ip.dst: {} dport: {})".format(
-                        ip.src, udp.sport, ip.dst, udp.dport
-                    )
+        # Check the port as well, a server address may also be used by a
+        # client, e.g., with several local addresses.
+        if src in self._server_addresses and sport in self._games:
+            to_server = False
+            client_ip, client_port, server_ip, server_port = dst, dport, src, sport
+        elif dst in self._server_addresses and dport in self._games:
+            to_server = True
+            client_ip, client_port, server_ip, server_port = src, sport, dst, dport
+        elif src in self._server_addresses or dst in self._server_addresses:
+            logger.warning(
+                "Observed packet with UDP port mismatch (ip.src: {}, sport: {}, ip.dst: {} dport: {})".format(
+                    format_address(src), sport, format_address(dst), dport
+                )
+            )
+            return
+        else:
+            logger.warning(
+                "PB server matches neither source ({}) nor destination ({})".format(
+                    format_address(src), format_address(dst)
                 )
+            )
+            return
+
+        game = self._games[server_port]
+        self._handlers[server_port](
+            game,
+            to_server,
+            client_ip,
+            client_port,
+            server_ip,
+            server_port,
+            payload,
+            now,
+        )
+
+    def start(self, now):
+        # Starts the virtual time, e.g., at the first packet of a capture file.
+        self._clock.reset(now)
+        for game in self._games.values():
+            game.reset(now)
+
+    def replay_packet(self, src, sport, dst, dport, payload, now):
+        # Handles a packet in virtual time, the periodic checks up to now
+        # are run before.
+        self._clock.advance_to(now)
+        self._handle_udp(src, sport, dst, dport, payload, now)
+
+    def analyze_file(self, path):
+        # Runs the detection on a capture file in virtual time.
+        packets = 0
+        first_ts = last_ts = None
+        for linktype, now, frame in read_packets(path):
+            parsed = parse_frame(linktype, frame)
+            if parsed is None:
+                continue
+            if first_ts is None:
+                first_ts = now
+                self.start(now)
+            self.replay_packet(*parsed, now)
+            packets += 1
+            last_ts = now
+        return {"packets": packets, "start": first_ts, "end": last_ts}
+
+    def connections(self, params):
+        # Used for the /connections route of the ApiServer.
+        selected = params.get("game")
+        games = {}
+        for port, game in self._games.items():
+            if selected and game.game_id not in selected:
+                continue
+            games[game.game_id] = game.snapshot()
+            games[game.game_id]["connections"] = []
+
+        for registry in self._unique_registries():
+            for con in registry.snapshot():
+                game = self._games[con["server_port"]]
+                if game.game_id in games:
+                    games[game.game_id]["connections"].append(con)
+        return games
+
+    def clients(self, params):
+        # Used for the /clients route of the ApiServer.
+        selected = params.get("game")
+        games = self.top_clients()
+        return {
+            game_id: [
+                {"client_ip": client, "bytes": count, "error": error}
+                for client, count, error in clients
+            ]
+            for game_id, clients in games.items()
+            if not selected or game_id in selected
+        }
+
+    def top_clients(self):
+        games = {}
+        for registry in self._unique_registries():
+            games.update(registry.top_clients(self._top_clients))
+        return games
+
+    def _unique_registries(self):
+        # Without isolation, all games share one registry.
+        return {id(r): r for r in self._registries.values()}.values()
 
     @property
     def _filter(self):
-        f = f"udp and (src host {self._ip_address} and ("
-        f += " or ".join([f"src port {game.port}" for game in self._games.values()])
-        f += f")) or (dst host {self._ip_address} and ("
-        f += " or ".join([f"dst port {game.port}" for game in self._games.values()])
-        f += "))"
+        src_hosts = " or ".join(f"src host {a}" for a in self._ip_addresses)
+        dst_hosts = " or ".join(f"dst host {a}" for a in self._ip_addresses)
+        src_ports = " or ".join(f"src port {port}" for port in self._games)
+        dst_ports = " or ".join(f"dst port {port}" for port in self._games)
+        f = (
+            f"udp and ((({src_hosts}) and ({src_ports}))"
+            f" or (({dst_hosts}) and ({dst_ports})))"
+        )
         logging.debug(f"Using filter: '{f}'")
         return f
 
-    def analyze_traffic(self, device):
+    def monitor_health(self, devices, stall_timeout=10):
+        # Started before analyze_traffic, so the routes of the ApiServer
+        # exist from the start.
+        self.health = HealthMonitor(
+            devices, self._games.values(), stall_timeout, clock=self._clock
+        )
+        self.health.start()
+        return self.health
+
+    def analyze_traffic(self, devices):
+        health = self.health
+        # WatchdogSec of the service is 30 seconds.
+        backoff = Backoff(initial=1, maximum=20)
         while True:
+            capture = None
             try:
-                # With timeout = None and count = 0, this should never complete without an exception
-                sniff(
-                    prn=self._handle_packet,
-                    filter=self._filter,
-                    timeout=None,
-                    store=0,
-                    count=0,
-                    iface=device,  # None for sniffing on all.
-                )
+                capture = Capture(devices, self._filter)
+                if health is not None:
+                    health.attach(capture)
+                # Only returns if the health monitor stopped a stalled capture
+                capture.run(self._handle_frame)
+                logger.info("capture stopped by the health monitor.")
             except KeyboardInterrupt:
                 logger.info("stopping watchdog.")
                 return
             except Exception as e:
                 logger.error("exception from sniffing: {}".format(e))
                 logger.error(traceback.format_exc())
-            else:
-                logger.error("sniff returned normally, this should never happen.")
+                process_metrics.capture_errors += 1  # collect metrics
+            finally:
+                if capture is not None:
+                    capture.close()
 
-            capture_errors_total.inc()  # collect metrics
-            time.sleep(10)
+            # A capture that delivered frames worked for a while, so the
+            # next failure starts with a short delay again.
+            if capture is not None and any(capture.frames.values()):
+                backoff.reset()
+            delay = backoff.next()
+            if health is not None:
+                health.detach(delay)
+            logger.info(f"reopening the capture in {delay:.1f}s")
+            time.sleep(delay)
 
 
 def toml_provider(file_path, cmd_name):
-    return toml.load(file_path)
+    import toml
+
+    config = toml.load(file_path)
+    # Single values are still supported for options that can be given
+    # multiple times.
+    for key in ("interface", "address"):
+        if isinstance(config.get(key), str):
+            config[key] = [config[key]]
+    return config
 
 
 @click.command()
 @click.option(
     "--interface",
     type=str,
-    required=True,
+    multiple=True,
     metavar="INTERFACE",
-    help="The interface to listen to, e.g., eth0",
+    help="The interface to listen to, e.g., eth0. Can be given multiple times.",
+)
+@click.option(
+    "-r",
+    "--read",
+    type=click.Path(exists=True, dir_okay=False),
+    multiple=True,
+    metavar="FILE",
+    help="Analyze pcap/pcapng capture files instead of listening to an interface. No actions are taken.",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    metavar="COUNT",
+    help="Number of processes for analyzing capture files, defaults to the number of CPUs.",
 )
 @click.option(
     "--address",
     type=str,
     required=True,
+    multiple=True,
     metavar="IP",
-    help="The IP address used for the PB server.",
+    help="The IP address used for the PB server. Can be given multiple times.",
 )
 @click.option(
     "-g",
@@ -172,6 +394,25 @@ def toml_provider(file_path, cmd_name):
     default=2000,
     help="Number of stray packets after which the client is disconnected.",
 )
+@click.option(
+    "--freeze-timeout",
+    metavar="SECONDS",
+    type=float,
+    default=18,
+    help="Time without active server packets after which a game is considered frozen.",
+)
+@click.option(
+    "--adaptive-thresholds/--no-adaptive-thresholds",
+    default=False,
+    help="Raise the packet limit and freeze timeout per game, up to twice, if its uploads and server pauses are longer than usual.",
+)
+@click.option(
+    "--game-config",
+    type=click.Path(exists=True, dir_okay=False),
+    default=None,
+    metavar="FILE",
+    help="TOML file with settings per game in [games.GAME_ID] tables and [defaults].",
+)
 @click.option(
     "--script-path",
     default=sys.path[0],
@@ -182,25 +423,175 @@ def toml_provider(file_path, cmd_name):
     default="",
     help="enable prometheus metrics at given address:port, set to empty to disable",
 )
+@click.option(
+    "--prometheus-interval",
+    metavar="SECONDS",
+    type=float,
+    default=1.0,
+    help="Render the prometheus metrics at most once per interval and serve the cached result.",
+)
+@click.option(
+    "--isolate-games/--no-isolate-games",
+    default=False,
+    help="Process each game on its own worker thread with its own connection state.",
+)
+@click.option(
+    "--queue-size",
+    metavar="COUNT",
+    type=int,
+    default=10000,
+    help="Number of queued packets per game before packets are dropped (with --isolate-games), can be set per game in the game config.",
+)
+@click.option(
+    "--latency-budget",
+    metavar="SECONDS",
+    type=float,
+    default=1.0,
+    help="Queueing delay per game that is counted as exceeding the budget (with --isolate-games), can be set per game in the game config.",
+)
+@click.option(
+    "--top-clients",
+    metavar="COUNT",
+    type=int,
+    default=10,
+    help="Number of clients with the most traffic per game that are exported.",
+)
+@click.option(
+    "--max-connections",
+    metavar="COUNT",
+    type=click.IntRange(min=1),
+    default=1024,
+    show_default=True,
+    help="Maximum number of tracked connections of all games, idle ones are evicted beyond this. Split evenly between the games with --isolate-games.",
+)
+@click.option(
+    "--probation-size",
+    metavar="COUNT",
+    type=click.IntRange(min=1),
+    default=256,
+    show_default=True,
+    help="Slots for new flows of all games until packets in both directions are seen. Split evenly between the games with --isolate-games.",
+)
+@click.option(
+    "--api",
+    default="",
+    help="enable the HTTP/JSON query API at given address:port, set to empty to disable",
+)
+@click.option(
+    "--event-log",
+    "event_log_path",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="append structured events as JSON lines to this file",
+)
+@click.option(
+    "--history",
+    "history_path",
+    default=None,
+    type=click.Path(dir_okay=False),
+    help="record sessions and events in this SQLite file, see civpb-history",
+)
+@click.option(
+    "--journald/--no-journald",
+    default=False,
+    help="send structured events to the systemd journal",
+)
+@click.option(
+    "--revive-backend",
+    type=click.Choice(["script", "native"]),
+    default="script",
+    help="Run the revive actions with the scripts of --script-path or signal the game processes directly.",
+)
+@click.option(
+    "--dry-run/--no-dry-run",
+    default=False,
+    help="Only log and report the revive actions and disconnects instead of running them.",
+)
+@click.option(
+    "--stall-timeout",
+    type=float,
+    default=10,
+    show_default=True,
+    help="Minimum seconds without captured packets on an interface while clients are connected before the capture is reopened. Longer if the interface is usually quieter.",
+)
 @click.option("--dump-packets", default=None, type=click.File("w+"))
 @click.option("--use-pcap/--no-use-pcap", default=False)
 @click_config_file.configuration_option(provider=toml_provider, implicit=False)
 @click_log.simple_verbosity_option(logger)
 def main(
     interface,
+    read,
+    jobs,
     address,
     games,
     packet_limit,
+    freeze_timeout,
+    adaptive_thresholds,
+    game_config,
     script_path,
     prometheus,
+    prometheus_interval,
+    isolate_games,
+    queue_size,
+    latency_budget,
+    top_clients,
+    max_connections,
+    probation_size,
+    api,
+    event_log_path,
+    history_path,
+    journald,
+    revive_backend,
+    dry_run,
+    stall_timeout,
     dump_packets,
     use_pcap,
 ):
+    if game_config:
+        import toml
+
+        game_config = toml.load(game_config)
+
+    if read:
+        result = analyze_files(
+            list(read),
+            dict(
+                ip_addresses=address,
+                game_args=games,
+                packet_limit=packet_limit,
+                script_path=script_path,
+                dump_packets=None,
+                freeze_timeout=freeze_timeout,
+                adaptive_thresholds=adaptive_thresholds,
+                game_config=game_config,
+            ),
+            jobs,
+        )
+        click.echo(json.dumps(result, indent=2))
+        return
+    if not interface:
+        raise click.UsageError("Either --interface or --read is required.")
+
     if use_pcap:
-        scapy.config.conf.use_pcap = True
+        from scapy.config import conf
+
+        conf.use_pcap = True
 
     if prometheus:
-        start_metric_server(prometheus)
+        start_metric_server(prometheus, prometheus_interval)
+
+    if event_log_path:
+        event_log.add_sink(JsonLinesSink(event_log_path))
+    if history_path:
+        event_log.add_sink(HistorySink(history_path))
+    if journald:
+        event_log.add_sink(JournaldSink())
+
+    api_server = None
+    if api:
+        event_log.enable()
+        api_server = ApiServer(api)
+        api_server.add_route("/events", event_log.query)
 
     logger.info("Pitboss upload killer running.")
 
@@ -208,7 +599,33 @@ def main(
         logger.info("will dump all packets to file")
         dump_packets.write(f"starting packet dump {datetime.now()}\n")
 
-    watchdog = Watchdog(address, games, packet_limit, script_path, dump_packets)
+    watchdog = Watchdog(
+        address,
+        games,
+        packet_limit,
+        script_path,
+        dump_packets,
+        isolate_games=isolate_games,
+        queue_size=queue_size,
+        latency_budget=latency_budget,
+        top_clients=top_clients,
+        max_connections=max_connections,
+        probation_size=probation_size,
+        freeze_timeout=freeze_timeout,
+        adaptive_thresholds=adaptive_thresholds,
+        game_config=game_config,
+        dry_run=dry_run,
+        revive_backend=revive_backend,
+    )
+    health = watchdog.monitor_health(interface, stall_timeout)
+    if prometheus:
+        register_top_clients(watchdog.top_clients)
+    if api_server:
+        api_server.add_route("/clients", watchdog.clients)
+        api_server.add_route("/connections", watchdog.connections)
+        api_server.add_route("/healthz", health.healthz)
+        api_server.add_route("/readyz", health.readyz)
+        api_server.start()
     watchdog.analyze_traffic(interface)
 
 
@@ -10,13 +10,14 @@ setup(
     entry_points="""
       [console_scripts]
       civpb-watchdog=civpb_watchdog:main
+      civpb-history=civpb_watchdog.history:main
       """,
     install_requires=[
         "click",
         "click-config-file",
         "click_log",
+        "importlib_metadata; python_version < '3.8'",
         "prometheus_client",
-        "setuptools",
         "scapy",
         "toml",
     ],